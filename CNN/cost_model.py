@@ -0,0 +1,196 @@
+'''
+cost_model.py: Per-layer cost of a network architecture.
+
+`layer_costs` takes a list of layers (as given to Network, before or after it
+is built) and a mini-batch size, and returns for every layer:
+
+    output_shape        shape of one example at the output of the layer
+    flops_forward       floating point operations of the forward pass
+    flops_backward      the same for the backward pass (the gradients of the
+                        weights, and of the input except for the first layer)
+    param_bytes         weights and biases
+    activation_bytes_forward   the maps the forward pass keeps for the
+                        backward pass (before and after pooling)
+    activation_bytes_backward  the gradients of those maps and of the input
+    workspace_bytes     the im2col matrix of one image (CorrMM convolutions)
+    optimizer_bytes     the optimizer state of the weights (the velocities
+                        of nesterov_momentum by default)
+
+Multiply-adds count as two operations; the bias, the activation, the pooling
+and the softmax count one or a few per value. `profile` times the forward and
+backward passes of every layer of a built Network on random data and adds the
+measured times to the costs, and `report` prints them side by side:
+
+    costs = cost_model.profile(net, mini_batch_size)
+    print cost_model.report(costs)
+'''
+
+#### Libraries
+# Standard library
+import time
+
+# Third-party libraries
+import numpy as np
+import theano
+import theano.tensor as T
+
+
+# Optimizer state per weight, in copies of the weights
+OPTIMIZER_STATES = {'sgd': 0, 'momentum': 1, 'nesterov_momentum': 1, 'RMSprop': 1}
+
+def layer_costs(layers, mini_batch_size, optimizer='nesterov_momentum', itemsize=None):
+    """Return the list of the costs (dictionaries, see the module docstring)
+    of `layers` for minibatches of `mini_batch_size` examples trained with
+    `optimizer` (one of OPTIMIZER_STATES). `itemsize` is the bytes per
+    value, that of floatX by default."""
+    if optimizer not in OPTIMIZER_STATES:
+        raise ValueError('Unknown optimizer %r, expected one of %s'
+                         % (optimizer, sorted(OPTIMIZER_STATES)))
+    itemsize = itemsize or np.dtype(theano.config.floatX).itemsize
+    B = mini_batch_size
+    costs = []
+    for j, layer in enumerate(layers):
+        first = j == 0
+        cost = {'layer': layer.__class__.__name__, 'workspace_bytes': 0}
+        if hasattr(layer, 'filter_shape'):
+            F, C, kh, kw = layer.filter_shape
+            H, W = layer.image_shape[2:]
+            Ho, Wo = H - kh + 1, W - kw + 1
+            conv_out = F * Ho * Wo
+            macs = conv_out * C * kh * kw
+            out_shape = (F, Ho, Wo)
+            pooled = 0
+            if getattr(layer, 'poolsize', None):
+                out_shape = (F, Ho // layer.poolsize[0], Wo // layer.poolsize[1])
+                pooled = int(np.prod(out_shape))
+            cost['flops_forward'] = B * (2 * macs + 2 * conv_out + (conv_out if pooled else 0))
+            cost['flops_backward'] = B * (2 * macs * (1 if first else 2) + 2 * conv_out
+                                          + (conv_out if pooled else 0))
+            cost['activation_bytes_forward'] = B * (conv_out + pooled) * itemsize
+            cost['activation_bytes_backward'] = B * (conv_out + pooled +
+                                                     (0 if first else C * H * W)) * itemsize
+            cost['workspace_bytes'] = C * kh * kw * Ho * Wo * itemsize
+            params = F * C * kh * kw + F
+        elif hasattr(layer, 'n_in'):
+            n_in, n_out = layer.n_in, layer.n_out
+            out_shape = (n_out,)
+            # a LowRankFullyConnectedLayer multiplies by its two factors,
+            # through `rank` intermediate values
+            rank = getattr(layer, 'rank', 0)
+            macs = rank * (n_in + n_out) if rank else n_in * n_out
+            # the bias and the activation, or the softmax
+            elementwise = 2 if hasattr(layer, 'activation_fn') else 5
+            dropout = n_in if getattr(layer, 'p_dropout', 0) else 0
+            cost['flops_forward'] = B * (2 * macs + elementwise * n_out + dropout)
+            cost['flops_backward'] = B * (2 * macs * (1 if first else 2)
+                                          + elementwise * n_out + dropout)
+            cost['activation_bytes_forward'] = B * (n_out + rank + dropout) * itemsize
+            cost['activation_bytes_backward'] = B * (n_out + rank +
+                                                     (0 if first else n_in)) * itemsize
+            params = macs + n_out
+        elif hasattr(layer, 'poolsize'):
+            C, H, W = layer.image_shape[1:]
+            out_shape = (C, H // layer.poolsize[0], W // layer.poolsize[1])
+            cost['flops_forward'] = cost['flops_backward'] = B * C * H * W
+            cost['activation_bytes_forward'] = B * int(np.prod(out_shape)) * itemsize
+            cost['activation_bytes_backward'] = B * (int(np.prod(out_shape)) + C * H * W) * itemsize
+            params = 0
+        else:
+            raise ValueError('No cost model for layer %d (%s)' % (j, cost['layer']))
+        cost['output_shape'] = out_shape
+        cost['param_bytes'] = params * itemsize
+        cost['optimizer_bytes'] = OPTIMIZER_STATES[optimizer] * params * itemsize
+        costs.append(cost)
+    return costs
+
+def total(costs):
+    """Return the sums of the numeric entries of `costs` over the layers; the
+    workspace is that of the largest layer, as it is allocated per layer."""
+    keys = [key for key in costs[0] if isinstance(costs[0][key], (int, long, float))]
+    sums = dict((key, sum(cost.get(key, 0) for cost in costs)) for key in keys)
+    sums['workspace_bytes'] = max(cost['workspace_bytes'] for cost in costs)
+    return sums
+
+def _random_input(rng, shape, dtype):
+    "Random values of `dtype`: uniform in [0, 1), or over the range of an integer dtype."
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu':
+        info = np.iinfo(dtype)
+        return rng.randint(info.min, int(info.max) + 1, shape).astype(dtype)
+    return rng.uniform(0, 1, shape).astype(dtype)
+
+def _best_time(f, args, repeats):
+    f(*args)
+    times = []
+    for k in xrange(repeats):
+        start = time.time()
+        f(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+def profile(net, mini_batch_size=None, repeats=5, optimizer='nesterov_momentum'):
+    """Return the costs of the layers of the built Network `net`, with the
+    measured seconds of the forward pass of every layer ('time_forward')
+    and of its backward pass ('time_backward', the gradients of the weights
+    and of the input given that of the output), the best of `repeats` runs
+    on random minibatches of `mini_batch_size` examples (that of `net` by
+    default)."""
+    B = mini_batch_size or net.mini_batch_size
+    costs = layer_costs(net.layers, B, optimizer)
+    rng = np.random.RandomState(0)
+    for j, (layer, cost) in enumerate(zip(net.layers, costs)):
+        if j == 0:
+            inpt = net.x
+            givens = {}
+            columns = (np.prod(net.input_mask.image_shape) if net.input_mask is not None
+                       else np.prod(layer.image_shape[1:]) if hasattr(layer, 'image_shape')
+                       else layer.n_in)
+            value = _random_input(rng, (B, columns), inpt.dtype)
+        else:
+            prev = net.layers[j-1]
+            inpt = prev.output.type()
+            givens = {prev.output: inpt, prev.output_dropout: inpt}
+            value = _random_input(rng, (B,) + costs[j-1]['output_shape'], inpt.dtype)
+        # the graphs of the layer on its own input
+        output, output_dropout = theano.clone([layer.output, layer.output_dropout],
+                                              replace=givens)
+        forward = theano.function([inpt], output)
+        wrt = layer.params + ([] if j == 0 else [inpt])
+        # the updates of the dropout streams belong to the original graph
+        backward = theano.function([inpt], T.grad(T.sum(T.sqr(output_dropout)), wrt),
+                                   no_default_updates=True)
+        cost['time_forward'] = _best_time(forward, [value], repeats)
+        cost['time_backward'] = max(0.0, _best_time(backward, [value], repeats)
+                                    - cost['time_forward'])
+    return costs
+
+def report(costs):
+    """Return the table of `costs`: the FLOPs, the bytes, and with measured
+    times (see `profile`) the share of the FLOPs of the forward and backward
+    passes predicted for every layer next to its share of the time."""
+    sums = total(costs)
+    timed = 'time_forward' in costs[0]
+    header = ('%-3s %-26s %-14s %9s %9s %9s %9s %9s %9s %9s' %
+              ('', 'layer', 'output', 'MFLOP fw', 'MFLOP bw', 'param KB', 'act fw MB',
+               'act bw MB', 'work MB', 'optim KB'))
+    if timed:
+        header += ' %8s %8s %7s %7s' % ('fw ms', 'bw ms', 'flop %', 'time %')
+    lines = [header]
+    flops = float(sums['flops_forward'] + sums['flops_backward'])
+    for j, cost in enumerate(costs + [sums]):
+        name = cost.get('layer', 'total')
+        line = ('%-3s %-26s %-14s %9.1f %9.1f %9.1f %9.1f %9.1f %9.1f %9.1f' %
+                (j if name != 'total' else '', name,
+                 'x'.join(map(str, cost.get('output_shape', ''))),
+                 cost['flops_forward'] / 1e6, cost['flops_backward'] / 1e6,
+                 cost['param_bytes'] / 1e3, cost['activation_bytes_forward'] / 1e6,
+                 cost['activation_bytes_backward'] / 1e6, cost['workspace_bytes'] / 1e6,
+                 cost['optimizer_bytes'] / 1e3))
+        if timed:
+            seconds = cost['time_forward'] + cost['time_backward']
+            line += ' %8.2f %8.2f %7.1f %7.1f' % (
+                cost['time_forward'] * 1e3, cost['time_backward'] * 1e3,
+                100 * (cost['flops_forward'] + cost['flops_backward']) / flops,
+                100 * seconds / (sums['time_forward'] + sums['time_backward']))
+        lines.append(line)
+    return '\n'.join(lines)
@@ -3,6 +3,8 @@ from datetime import datetime
 # Look for the data at:
 
 file_name = "../data/normal_shuffle/neumonia_dataset_interson_elDeform_0_2.pkl"
+# Sector mask of the probe (python sector_mask.py), or None to use the whole frames
+mask_file = None
 ########################################
 # HyperParameters
 startTime = datetime.now()
@@ -12,60 +14,89 @@ possible_lambda = [5.0,2.0,3.0,1.0,1.0/10.0,1.0/100.0,1.0/1000.0] #7
 #possible_lambda = [1.0] #7
 possible_mini_batch = [100]
 possible_dropout =0.5
+# Processes sharing each minibatch (parallel.py); set OMP_NUM_THREADS=1 when it is above 1
+workers = 1
+# Print the cost of every layer (cost_model.py), with its measured time, before training
+profile_layers = False
 ########################################
 # Import libraries
 import cPickle
+import os
 import network_interson
+import cost_model
 from network_interson import Network
 from layer_types import ConvPoolLayer, ConvLayer, FullyConnectedLayer, SigmoidLayer, SoftmaxLayer
+from sector_mask import SectorMask
 training_data, validation_data, test_data = network_interson.load_data_shared(filename= file_name)
 from network_interson import ReLU
 from theano.tensor import tanh
 
+# The frames are cropped to the bounding box of the scan sector, and the
+# image size of every layer follows from the crop
+sector = None
+frame_shape = (256, 256)
+if mask_file:
+	sector = SectorMask.load(mask_file, mode='crop')
+	frame_shape = sector.crop_shape
+s = [frame_shape]
+for pool in [0, 1, 1, 0, 0, 1, 0, 1, 0, 1]:
+	r, c = s[-1][0] - 2, s[-1][1] - 2
+	s.append((r // 2, c // 2) if pool else (r, c))
+
 ########################################
 #Actual training and research of Hyperparameters
 
-for i in range(len(possible_learning_rate)):
-	for j in range(len(possible_lambda)):
-		for z in range(len(possible_mini_batch)):
-			mini_batch_size = possible_mini_batch[z]
-			dropout = possible_dropout
-			net = Network([
-				ConvLayer(image_shape=(mini_batch_size, 1, 256,256), 
-					      filter_shape=(8, 1, 3, 3), 
-					      activation_fn=ReLU),
-				ConvPoolLayer(image_shape=(mini_batch_size, 8, 254,254), 
-					      filter_shape=(8, 8, 3, 3), 
-					      poolsize=(2, 2), activation_fn=ReLU),
-                                ConvPoolLayer(image_shape=(mini_batch_size, 8, 126,126), 
-					      filter_shape=(8, 8, 3, 3), 
-					      poolsize=(2, 2), activation_fn=ReLU),
-				ConvLayer(image_shape=(mini_batch_size, 8, 62,62), 
-					      filter_shape=(16, 8, 3, 3), 
-					      activation_fn=ReLU),
-				ConvLayer(image_shape=(mini_batch_size, 16, 60,60), 
-					      filter_shape=(16, 16, 3, 3), 
-					      activation_fn=ReLU),
-                                ConvPoolLayer(image_shape=(mini_batch_size, 16, 58,58), 
-					      filter_shape=(16, 16, 3, 3), 
-					      poolsize=(2, 2), activation_fn=ReLU),
-				ConvLayer(image_shape=(mini_batch_size, 16, 28,28), 
-					      filter_shape=(32, 16, 3, 3), 
-					      activation_fn=ReLU),
-                                ConvPoolLayer(image_shape=(mini_batch_size, 32, 26,26), 
-					      filter_shape=(32, 32, 3, 3), 
-					      poolsize=(2, 2), activation_fn=ReLU),
-				ConvLayer(image_shape=(mini_batch_size, 32, 12,12), 
-					      filter_shape=(32, 32, 3, 3), 
-					      activation_fn=ReLU),
-				ConvPoolLayer(image_shape=(mini_batch_size, 32, 10,10), 
-					      filter_shape=(32, 32,3, 3), 
-					      poolsize=(2, 2),activation_fn = ReLU),
-				FullyConnectedLayer(n_in=32*4*4, n_out= 10,activation_fn = ReLU, p_dropout = dropout),
-				FullyConnectedLayer(n_in=10, n_out= 5,activation_fn = ReLU, p_dropout = dropout),
-				SoftmaxLayer(n_in=5, n_out=2)], mini_batch_size)
-			net.SGD(training_data, 50, mini_batch_size, possible_learning_rate[i],validation_data, test_data,lmbda = possible_lambda[j])
+# One network (and one set of compiled functions) per architecture; its
+# weights are reset before each learning rate/lambda pair
+for z in range(len(possible_mini_batch)):
+	mini_batch_size = possible_mini_batch[z]
+	dropout = possible_dropout
+	net = Network([
+		ConvLayer(image_shape=(mini_batch_size, 1)+s[0], 
+			      filter_shape=(8, 1, 3, 3), 
+			      activation_fn=ReLU),
+		ConvPoolLayer(image_shape=(mini_batch_size, 8)+s[1], 
+			      filter_shape=(8, 8, 3, 3), 
+			      poolsize=(2, 2), activation_fn=ReLU),
+                                ConvPoolLayer(image_shape=(mini_batch_size, 8)+s[2], 
+			      filter_shape=(8, 8, 3, 3), 
+			      poolsize=(2, 2), activation_fn=ReLU),
+		ConvLayer(image_shape=(mini_batch_size, 8)+s[3], 
+			      filter_shape=(16, 8, 3, 3), 
+			      activation_fn=ReLU),
+		ConvLayer(image_shape=(mini_batch_size, 16)+s[4], 
+			      filter_shape=(16, 16, 3, 3), 
+			      activation_fn=ReLU),
+                                ConvPoolLayer(image_shape=(mini_batch_size, 16)+s[5], 
+			      filter_shape=(16, 16, 3, 3), 
+			      poolsize=(2, 2), activation_fn=ReLU),
+		ConvLayer(image_shape=(mini_batch_size, 16)+s[6], 
+			      filter_shape=(32, 16, 3, 3), 
+			      activation_fn=ReLU),
+                                ConvPoolLayer(image_shape=(mini_batch_size, 32)+s[7], 
+			      filter_shape=(32, 32, 3, 3), 
+			      poolsize=(2, 2), activation_fn=ReLU),
+		ConvLayer(image_shape=(mini_batch_size, 32)+s[8], 
+			      filter_shape=(32, 32, 3, 3), 
+			      activation_fn=ReLU),
+		ConvPoolLayer(image_shape=(mini_batch_size, 32)+s[9], 
+			      filter_shape=(32, 32,3, 3), 
+			      poolsize=(2, 2),activation_fn = ReLU),
+		FullyConnectedLayer(n_in=32*s[10][0]*s[10][1], n_out= 10,activation_fn = ReLU, p_dropout = dropout),
+		FullyConnectedLayer(n_in=10, n_out= 5,activation_fn = ReLU, p_dropout = dropout),
+		SoftmaxLayer(n_in=5, n_out=2)], mini_batch_size, input_mask=sector)
+	if profile_layers:
+		print cost_model.report(cost_model.profile(net))
+	for i in range(len(possible_learning_rate)):
+		for j in range(len(possible_lambda)):
 			name = 'net_normal0_%(learning)g_%(lambda)g_%(mini_batch)g_%(dropout)g.pkl' %{"learning": possible_learning_rate[i],"lambda":possible_lambda[j],"mini_batch":mini_batch_size,"dropout":dropout}
+			if os.path.exists(name):
+				continue # trained before the sweep was interrupted
+			# an interrupted configuration resumes from its last epoch
+			net.reset_params()
+			net.SGD(training_data, 50, mini_batch_size, possible_learning_rate[i],validation_data, test_data,lmbda = possible_lambda[j],
+				checkpoint = name + '.checkpoint', log_file = 'sweep_log.jsonl',
+				workers = workers)
 			f = file(name,'wb')
 			cPickle.dump(net,f,protocol=cPickle.HIGHEST_PROTOCOL)
 			f.close()
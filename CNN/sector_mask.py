@@ -0,0 +1,120 @@
+'''
+sector_mask.py: Keep only the pixels of the ultrasound scan sector.
+
+The Interson frames show a fan-shaped sector on a black background, and a
+large part of every 256x256 frame lies outside of it. A SectorMask is estimated
+once per probe configuration from a sample of frames (the pixels that are lit
+in some of them, with the holes filled), saved, and then applied as the first
+step of the network graph (Network(..., input_mask=mask)), so training and
+prediction/class_p.py see exactly the same pixels:
+
+    mode='crop'    the frames are cut to the bounding box of the sector (and
+                   the pixels outside the sector are zeroed), for the
+                   convolutional networks: every layer works on a smaller image.
+    mode='pixels'  only the pixels inside the sector are kept, for the fully
+                   connected and logistic models: the first layer has one
+                   input per sector pixel instead of 65536.
+
+command line: python sector_mask.py ../data/neumonia_dataset_interson.store sector_interson.pkl
+'''
+
+#### Libraries
+# Standard library
+import argparse
+import cPickle
+
+# Third-party libraries
+import numpy as np
+from scipy import ndimage
+
+
+MODES = ['crop', 'pixels']
+
+
+class SectorMask(object):
+
+    def __init__(self, mask, mode='crop'):
+        """`mask` is a boolean image, True inside the scan sector. `mode` is
+        'crop' or 'pixels' (see the module docstring)."""
+        if mode not in MODES:
+            raise ValueError('Unknown mode %r, expected one of %s' % (mode, MODES))
+        self.mask = np.asarray(mask, dtype=bool)
+        self.mode = mode
+        self.image_shape = self.mask.shape
+        rows = np.flatnonzero(self.mask.any(axis=1))
+        cols = np.flatnonzero(self.mask.any(axis=0))
+        self.bbox = (int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1)
+        self.crop_shape = (self.bbox[1] - self.bbox[0], self.bbox[3] - self.bbox[2])
+        self.crop_mask = self.mask[self.bbox[0]:self.bbox[1], self.bbox[2]:self.bbox[3]]
+        self.index = np.flatnonzero(self.mask).astype('int32')
+
+    @property
+    def n_in(self):
+        "Number of inputs per frame after the mask is applied."
+        if self.mode == 'crop':
+            return self.crop_shape[0] * self.crop_shape[1]
+        return len(self.index)
+
+    @classmethod
+    def estimate(cls, frames, image_shape=(256, 256), mode='crop', threshold=0,
+                 min_fraction=0.01, sample=2000):
+        """Estimate the sector from `frames` (rows of `image_shape` pixels):
+        the pixels above `threshold` in at least `min_fraction` of up to
+        `sample` frames spread over the array, keeping the largest connected
+        region with its holes (dark tissue inside the sector) filled."""
+        rows = np.unique(np.linspace(0, len(frames) - 1, min(sample, len(frames))).astype(int))
+        lit = np.zeros(image_shape, dtype='int32')
+        for start in xrange(0, len(rows), 256):
+            block = np.asarray(frames[rows[start:start + 256]])
+            lit += (block.reshape((-1,) + tuple(image_shape)) > threshold).sum(axis=0)
+        mask = lit >= min_fraction * len(rows)
+        labels, count = ndimage.label(mask)
+        if count > 1:
+            sizes = ndimage.sum(mask, labels, range(1, count + 1))
+            mask = labels == np.argmax(sizes) + 1
+        return cls(ndimage.binary_fill_holes(mask), mode)
+
+    def apply(self, images):
+        """Return the masked rows of `images`, a matrix of flattened frames.
+        It works on numpy arrays and on Theano matrices alike, so it can be
+        used in the graph (see Network) or on the host."""
+        if self.mode == 'pixels':
+            return images[:, self.index]
+        r0, r1, c0, c1 = self.bbox
+        frames = images.reshape((images.shape[0],) + self.image_shape)
+        crop = frames[:, r0:r1, c0:c1] * np.asarray(self.crop_mask, dtype=images.dtype)
+        return crop.reshape((images.shape[0], self.n_in))
+
+    def save(self, filename):
+        f = open(filename, 'wb')
+        cPickle.dump({'mask': self.mask}, f, protocol=cPickle.HIGHEST_PROTOCOL)
+        f.close()
+
+    @classmethod
+    def load(cls, filename, mode='crop'):
+        f = open(filename, 'rb')
+        saved = cPickle.load(f)
+        f.close()
+        return cls(saved['mask'], mode)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Estimate the scan sector of a probe from a dataset.')
+    parser.add_argument('dataset', help='a dataset store or pickle')
+    parser.add_argument('mask_file')
+    parser.add_argument('--threshold', type=float, default=0)
+    parser.add_argument('--min-fraction', type=float, default=0.01)
+    args = parser.parse_args()
+    import dataset_store
+    if dataset_store.is_store(args.dataset):
+        frames = dataset_store.open_store(args.dataset)[0][0]
+    else:
+        f = open(args.dataset, 'rb')
+        frames = np.asarray(cPickle.load(f)[0][0])
+        f.close()
+    sector = SectorMask.estimate(frames, threshold=args.threshold,
+                                 min_fraction=args.min_fraction)
+    sector.save(args.mask_file)
+    print 'Sector: %d of %d pixels, bounding box %dx%d' % (
+        len(sector.index), sector.mask.size, sector.crop_shape[0], sector.crop_shape[1])
@@ -20,6 +20,7 @@ from theano.tensor.nnet import categorical_crossentropy
 from theano.tensor.nnet import softmax, sigmoid
 from theano.tensor import shared_randomstreams
 from theano.tensor.signal import downsample
+import conv_algorithms
 from learning_functions import sgd, apply_nesterov_momentum, nesterov_momentum, get_or_compute_grads
 
 
@@ -42,7 +43,7 @@ class ConvPoolLayer():
     """
 
     def __init__(self,filter_shape,image_shape, poolsize=(2, 2), 
-                 activation_fn=sigmoid):
+                 activation_fn=sigmoid, algorithm='auto'):
         """`filter_shape` is a tuple of length 4, whose entries are the number
         of filters, the number of input feature maps, the filter height, and the 
         filter width.
@@ -50,15 +51,22 @@ class ConvPoolLayer():
         `image_shape` is a tuple of length 4, whose entries are the
         mini-batch size, the number of input feature maps, the image
         height, and the image width.
+        The mini-batch size is only a hint: the batch dimension of the
+        graph is symbolic, so the layer takes any number of images.
 
         `poolsize` is a tuple of length 2, whose entries are the y and
         x pooling sizes.
 
+        `algorithm` is the convolution algorithm, one of
+        conv_algorithms.ALGORITHMS, or 'auto' for the fastest one on this
+        machine for the shapes and the mini-batch size of the network.
+
         """
         self.filter_shape = filter_shape
         self.image_shape = image_shape
         self.poolsize = poolsize
         self.activation_fn=activation_fn
+        self.algorithm = algorithm
         # initialize weights and biases
 	n_in = np.prod(filter_shape[1:])
         n_out = (filter_shape[0]*np.prod(filter_shape[2:])/np.prod(poolsize))
@@ -74,10 +82,10 @@ class ConvPoolLayer():
         self.params = [self.w, self.b]
 
     def set_inpt(self, inpt, inpt_dropout, mini_batch_size):
-        self.inpt = inpt.reshape(self.image_shape)
-        conv_out = conv.conv2d(
-            input=self.inpt, filters=self.w, filter_shape=self.filter_shape,
-            image_shape=self.image_shape)
+        self.inpt = inpt.reshape((-1,) + tuple(self.image_shape[1:]))
+        conv_out = conv_algorithms.conv2d(
+            self.inpt, self.w, self.filter_shape, self.image_shape,
+            self.algorithm, mini_batch_size)
 	act_out = self.activation_fn(conv_out + self.b.dimshuffle('x',0,'x','x'))
 	pooled_out = downsample.max_pool_2d(input=act_out,ds=self.poolsize,ignore_border=True)
         self.output = pooled_out
@@ -85,11 +93,12 @@ class ConvPoolLayer():
 
 #######################################
 class ConvLayer():
-    def __init__(self,filter_shape,image_shape, activation_fn=sigmoid):
+    def __init__(self,filter_shape,image_shape, activation_fn=sigmoid, algorithm='auto'):
         
         self.filter_shape = filter_shape
         self.image_shape = image_shape
         self.activation_fn=activation_fn
+        self.algorithm = algorithm
         # initialize weights and biases
 	n_in = np.prod(filter_shape[1:])
         n_out = filter_shape[0]*np.prod(filter_shape[2:])
@@ -105,10 +114,10 @@ class ConvLayer():
         self.params = [self.w, self.b]
 
     def set_inpt(self, inpt, inpt_dropout, mini_batch_size):
-        self.inpt = inpt.reshape(self.image_shape)
-        conv_out = conv.conv2d(
-            input=self.inpt, filters=self.w, filter_shape=self.filter_shape,
-            image_shape=self.image_shape)
+        self.inpt = inpt.reshape((-1,) + tuple(self.image_shape[1:]))
+        conv_out = conv_algorithms.conv2d(
+            self.inpt, self.w, self.filter_shape, self.image_shape,
+            self.algorithm, mini_batch_size)
 	act_out = self.activation_fn(conv_out + self.b.dimshuffle('x',0,'x','x'))
         self.output = act_out
         self.output_dropout = self.output # no dropout in the convolutional layers
@@ -135,15 +144,71 @@ class FullyConnectedLayer():
         self.params = [self.w, self.b]
 
     def set_inpt(self, inpt, inpt_dropout, mini_batch_size):
-        self.inpt = inpt.reshape((mini_batch_size, self.n_in))
+        self.inpt = inpt.reshape((-1, self.n_in))
         self.output = self.activation_fn(
             (1-self.p_dropout)*T.dot(self.inpt, self.w) + self.b)
         self.y_out = T.argmax(self.output, axis=1)
         self.inpt_dropout = dropout_layer(
-            inpt_dropout.reshape((mini_batch_size, self.n_in)), self.p_dropout)
+            inpt_dropout.reshape((-1, self.n_in)), self.p_dropout)
         self.output_dropout = self.activation_fn(
             T.dot(self.inpt_dropout, self.w) + self.b)
 
+############################################
+class LowRankFullyConnectedLayer():
+    """A FullyConnectedLayer whose weight matrix is the product of the
+    (n_in, rank) matrix `u` and the (rank, n_out) matrix `v`, so that the
+    layer has rank*(n_in + n_out) weights instead of n_in*n_out, and its
+    products cost as much less.
+
+    """
+
+    def __init__(self, n_in, n_out, rank, activation_fn=sigmoid, p_dropout=0.0,
+                 w=None, b=None):
+        """`w` and `b` are optional trained weights (n_in, n_out) and biases,
+        of a FullyConnectedLayer for instance (see `factorize`): `u` and `v`
+        are then the truncated SVD of `w`, its best approximation of rank
+        `rank`. By default they are random, scaled so that their product
+        has the variance of the weights of a FullyConnectedLayer.
+
+        """
+        self.n_in = n_in
+        self.n_out = n_out
+        self.rank = rank
+        self.activation_fn = activation_fn
+        self.p_dropout = p_dropout
+        if w is None:
+            u = np.random.normal(loc=0.0, scale=np.sqrt(1.0/n_in), size=(n_in, rank))
+            v = np.random.normal(loc=0.0, scale=np.sqrt(1.0/rank), size=(rank, n_out))
+        else:
+            U, s, V = np.linalg.svd(np.asarray(w), full_matrices=False)
+            u = U[:, :rank] * np.sqrt(s[:rank])
+            v = np.sqrt(s[:rank])[:, None] * V[:rank]
+        self.u = theano.shared(np.asarray(u, dtype=theano.config.floatX), name='u', borrow=True)
+        self.v = theano.shared(np.asarray(v, dtype=theano.config.floatX), name='v', borrow=True)
+        self.b = theano.shared(
+            np.asarray(b if b is not None else np.zeros((n_out,)), dtype=theano.config.floatX),
+            name='b', borrow=True)
+        self.params = [self.u, self.v, self.b]
+        # regularized instead of a `w`, which is never formed
+        self.weights = [self.u, self.v]
+
+    def set_inpt(self, inpt, inpt_dropout, mini_batch_size):
+        self.inpt = inpt.reshape((-1, self.n_in))
+        self.output = self.activation_fn(
+            (1-self.p_dropout)*T.dot(T.dot(self.inpt, self.u), self.v) + self.b)
+        self.y_out = T.argmax(self.output, axis=1)
+        self.inpt_dropout = dropout_layer(
+            inpt_dropout.reshape((-1, self.n_in)), self.p_dropout)
+        self.output_dropout = self.activation_fn(
+            T.dot(T.dot(self.inpt_dropout, self.u), self.v) + self.b)
+
+def factorize(layer, rank):
+    """Return a LowRankFullyConnectedLayer of `rank` initialized with the
+    truncated SVD of the weights of the trained FullyConnectedLayer `layer`."""
+    return LowRankFullyConnectedLayer(
+        layer.n_in, layer.n_out, rank, layer.activation_fn, layer.p_dropout,
+        w=layer.w.get_value(), b=layer.b.get_value())
+
 
 
 #######################################
@@ -166,11 +231,11 @@ class SoftmaxLayer():
         self.params = [self.w, self.b]
 
     def set_inpt(self, inpt, inpt_dropout, mini_batch_size):
-        self.inpt = inpt.reshape((mini_batch_size, self.n_in))
+        self.inpt = inpt.reshape((-1, self.n_in))
         self.output = softmax((1-self.p_dropout)*T.dot(self.inpt, self.w) + self.b)
         self.y_out = T.argmax(self.output, axis=1)
         self.inpt_dropout = dropout_layer(
-            inpt_dropout.reshape((mini_batch_size, self.n_in)), self.p_dropout)
+            inpt_dropout.reshape((-1, self.n_in)), self.p_dropout)
         self.output_dropout = softmax(T.dot(self.inpt_dropout, self.w) + self.b)
 
     #def cost(self, net):
@@ -180,6 +245,10 @@ class SoftmaxLayer():
         "Return the cross entropy cost function"
         return T.mean(categorical_crossentropy(self.output_dropout,net.y))
 
+    def cost_validation(self,net):
+        "Return the cross entropy cost of the output without dropout"
+    	return T.mean(categorical_crossentropy(self.output,net.y))
+
     def accuracy(self, y):
         "Return the accuracy for the mini-batch."
         return T.mean(T.eq(y, self.y_out))
@@ -191,7 +260,17 @@ class SoftmaxLayer():
     def tru_pos(self, y):
 	return T.nonzero(T.and_(y,self.y_out))
     def tru_neg(self, y):
-	return T.nonzero(T.invert(T.or_(y,self.y_out)))
+	return T.nonzero(T.eq(T.or_(y,self.y_out), 0))
+
+    def confusion(self, y):
+        """Return the [TP, TN, FP, FN] counts of the mini-batch as one
+        vector, so they come out of a single forward pass."""
+        predicted = T.eq(self.y_out, 1)
+        condition = T.eq(y, 1)
+        return T.stack([T.sum(predicted * condition),
+                        T.sum((1 - predicted) * (1 - condition)),
+                        T.sum(predicted * (1 - condition)),
+                        T.sum((1 - predicted) * condition)])
 
 ##########################
 class SigmoidLayer():
@@ -213,17 +292,21 @@ class SigmoidLayer():
         self.params = [self.w, self.b]
 
     def set_inpt(self, inpt, inpt_dropout, mini_batch_size):
-        self.inpt = inpt.reshape((mini_batch_size, self.n_in))
+        self.inpt = inpt.reshape((-1, self.n_in))
         self.output = softmax((1-self.p_dropout)*T.dot(self.inpt, self.w) + self.b)
         self.y_out = T.argmax(self.output, axis=1)
         self.inpt_dropout = dropout_layer(
-            inpt_dropout.reshape((mini_batch_size, self.n_in)), self.p_dropout)
+            inpt_dropout.reshape((-1, self.n_in)), self.p_dropout)
         self.output_dropout = softmax(T.dot(self.inpt_dropout, self.w) + self.b)
 
     def cost(self, net):
         "Return the binary cross entropy function"
 	return T.mean(binary_crossentropy(self.output_dropout,net.y))
 
+    def cost_validation(self,net):
+        "Return the binary cross entropy of the output without dropout"
+	return T.mean(binary_crossentropy(self.output,net.y))
+
     def accuracy(self, y):
         "Return the accuracy for the mini-batch."
         return T.mean(T.eq(y, self.y_out))
@@ -235,7 +318,17 @@ class SigmoidLayer():
     def tru_pos(self, y):
 	return T.nonzero(T.and_(y,self.y_out))
     def tru_neg(self, y):
-	return T.nonzero(T.invert(T.or_(y,self.y_out)))
+	return T.nonzero(T.eq(T.or_(y,self.y_out), 0))
+
+    def confusion(self, y):
+        """Return the [TP, TN, FP, FN] counts of the mini-batch as one
+        vector, so they come out of a single forward pass."""
+        predicted = T.eq(self.y_out, 1)
+        condition = T.eq(y, 1)
+        return T.stack([T.sum(predicted * condition),
+                        T.sum((1 - predicted) * (1 - condition)),
+                        T.sum(predicted * (1 - condition)),
+                        T.sum((1 - predicted) * condition)])
 #### Miscellanea
 def size(data):
     "Return the size of the dataset `data`."
@@ -0,0 +1,227 @@
+'''
+parallel.py: Synchronous data-parallel training steps on the CPU cores.
+
+Network.SGD(..., workers=N) replaces its compiled training step by a
+DataParallelStep: every minibatch is split into N shards, the parent process
+computes the gradients of the first one while N - 1 forked worker processes
+compute the others, and the parent sums them and applies the Nesterov update.
+The workers inherit the compiled gradient function and the training data when
+they are forked, so only two row indices per shard go through the pipes. The
+gradients come back, and the updated weights go out, through shared memory:
+the weights of the workers are views of the same buffers, so publishing the
+new weights is one copy per parameter.
+
+The gradient of the minibatch is the average of the shard gradients weighted
+by their rows, so training matches the single process one (up to the order in
+which the floats are summed), except for the dropout masks, which every worker
+draws from its own random stream. Set OMP_NUM_THREADS=1 when the BLAS library
+is multithreaded, so that the processes do not compete for the cores.
+
+Only Theano on the CPU (device=cpu) can be forked this way: on the GPU the
+weights live in device memory, not in the shared buffers, and a forked CUDA
+context is unusable.
+'''
+
+#### Libraries
+# Standard library
+import multiprocessing
+
+# Third-party libraries
+import numpy as np
+import theano
+import theano.tensor as T
+
+
+def shared_array(shape, dtype):
+    "Return a numpy array of `shape` and `dtype` in memory shared with forked processes."
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape)) * dtype.itemsize
+    return np.frombuffer(multiprocessing.RawArray('b', max(size, 1)),
+                         dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+def require_cpu(what):
+    "Raise a ValueError unless Theano runs on the CPU (see the module docstring)."
+    if theano.config.device != 'cpu':
+        raise ValueError('%s needs Theano on the CPU (device=cpu), not on %s'
+                         % (what, theano.config.device))
+
+
+class DataParallelStep(object):
+
+    def __init__(self, cost, params, inputs, givens, updates, workers,
+                 mini_batch_size, num_examples, order=None):
+        """`cost` is the training cost of the rows `inputs[0]:inputs[1]` of
+        the training data (two int scalars, substituted by `givens`), and
+        `updates` a function returning the update dictionary of `params` for
+        a list of gradients (for instance learning_functions.nesterov_momentum
+        with a shared learning rate). `order`, the shared permutation of
+        Network.SGD(..., shuffle=True), is moved to shared memory so the
+        workers see the permutation of every epoch.
+
+        """
+        if workers > 1:
+            require_cpu('workers > 1')
+        self.params = params
+        self.workers = workers
+        self.mini_batch_size = mini_batch_size
+        self.num_examples = num_examples
+        start, stop = inputs
+        rows = T.cast(stop - start, theano.config.floatX)
+        grads = T.grad(cost, params)
+        # the shard sums, divided by the rows of the whole minibatch later
+        self.shard_function = theano.function(
+            inputs, [cost * rows] + [grad * rows for grad in grads], givens=givens)
+        grad_inputs = [param.type() for param in params]
+        update_dict = updates(grad_inputs)
+        self.update_function = theano.function(grad_inputs, [], updates=update_dict)
+        params_set = set(params)
+        self.velocities = [v for v in update_dict if v not in params_set]
+        self.order = order
+        if order is not None:
+            shared_order = shared_array(order.get_value(borrow=True).shape, 'int32')
+            shared_order[:] = order.get_value(borrow=True)
+            order.set_value(shared_order, borrow=True)
+        self._weights = [shared_array(p.get_value(borrow=True).shape, p.dtype)
+                         for p in params]
+        self._grads = [[shared_array(p.get_value(borrow=True).shape, p.dtype)
+                        for p in params] for k in xrange(workers - 1)]
+        self._processes = []
+        self._pipes = []
+
+    def start(self, random_states=()):
+        """Publish the current weights and fork the workers. The shared
+        `random_states` (the dropout streams) are reseeded in every worker."""
+        self.stop()
+        self._publish()
+        for k in xrange(1, self.workers):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=self._work, args=(k, child, random_states))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+            self._pipes.append(parent)
+
+    def _publish(self):
+        for param, weights in zip(self.params, self._weights):
+            np.copyto(weights, param.get_value(borrow=True))
+
+    def _work(self, k, pipe, random_states):
+        for param, weights in zip(self.params, self._weights):
+            param.set_value(weights, borrow=True)
+        for j, state in enumerate(random_states):
+            state.set_value(np.random.RandomState([k, j]))
+        grads = self._grads[k - 1]
+        while True:
+            shard = pipe.recv()
+            if shard is None:
+                break
+            outputs = self.shard_function(*shard)
+            for buf, grad in zip(grads, outputs[1:]):
+                np.copyto(buf, grad)
+            pipe.send(float(outputs[0]))
+
+    def __call__(self, minibatch_index):
+        """Train on minibatch `minibatch_index` and return its cost."""
+        start = minibatch_index * self.mini_batch_size
+        stop = min(start + self.mini_batch_size, self.num_examples)
+        shard = -(-(stop - start) // self.workers)
+        busy = []
+        for k, pipe in enumerate(self._pipes, 1):
+            first = min(start + k * shard, stop)
+            last = min(first + shard, stop)
+            if last > first:
+                pipe.send((first, last))
+                busy.append(k)
+        outputs = self.shard_function(start, min(start + shard, stop))
+        cost = float(outputs[0])
+        grads = outputs[1:]
+        for k in busy:
+            cost += self._pipes[k - 1].recv()
+            for grad, buf in zip(grads, self._grads[k - 1]):
+                grad += buf
+        rows = stop - start
+        self.update_function(*[grad / np.asarray(rows, dtype=grad.dtype) for grad in grads])
+        self._publish()
+        return cost / rows
+
+    def stop(self):
+        for pipe in self._pipes:
+            pipe.send(None)
+        for process in self._processes:
+            process.join()
+        self._processes = []
+        self._pipes = []
+
+
+class AsyncEvaluator(object):
+
+    def __init__(self, params, validate, test, evaluate):
+        """Evaluate snapshots of the weights `params` in a worker process
+        while training goes on. `validate` and `test` are the compiled
+        evaluations of the splits (Network.evaluation_function; `test` may be
+        None) and `evaluate` runs one of them and returns its cost, accuracy
+        and TP, TN, FP, FN counts. The worker's weights are views of the
+        snapshot buffers, which are also exposed as the shared variables
+        `snapshot`.
+
+        """
+        require_cpu('async_validation')
+        self.params = params
+        self.validate = validate
+        self.test = test
+        self.evaluate = evaluate
+        self._buffers = [shared_array(p.get_value(borrow=True).shape, p.dtype)
+                         for p in params]
+        self.snapshot = [theano.shared(buf, borrow=True) for buf in self._buffers]
+        self.pending = None
+        self._process = None
+
+    def start(self):
+        self.stop()
+        self._pipe, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=self._work, args=(child,))
+        self._process.daemon = True
+        self._process.start()
+
+    def _work(self, pipe):
+        for param, buf in zip(self.params, self._buffers):
+            param.set_value(buf, borrow=True)
+        while True:
+            best_sensitivity = pipe.recv()
+            if best_sensitivity is None:
+                break
+            validation = self.evaluate(self.validate)
+            TP, FN = validation[2], validation[5]
+            test = None
+            # the test split is only needed when the sensitivity improves
+            if (self.test is not None and TP + FN > 0 and
+                    TP / (TP + FN) >= best_sensitivity):
+                test = self.evaluate(self.test)
+            pipe.send((validation, test))
+
+    def submit(self, best_sensitivity, *tag):
+        """Copy the current weights into the snapshot and start evaluating
+        them; the test split is evaluated too if the validation sensitivity
+        reaches `best_sensitivity`. `tag` is returned with the results."""
+        for param, buf in zip(self.params, self._buffers):
+            np.copyto(buf, param.get_value(borrow=True))
+        self._pipe.send(best_sensitivity)
+        self.pending = tag
+
+    def result(self):
+        """Wait for the evaluation of the last snapshot and return its `tag`
+        followed by the validation and test results (None when the test
+        split was not evaluated)."""
+        validation, test = self._pipe.recv()
+        tag, self.pending = self.pending, None
+        return tag + (validation, test)
+
+    def stop(self):
+        if self._process is None:
+            return
+        if self.pending is not None:
+            self.result()
+        self._pipe.send(None)
+        self._process.join()
+        self._process = None
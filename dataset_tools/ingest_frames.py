@@ -0,0 +1,161 @@
+'''
+ingest_frames.py: Build a training dataset from exported ultrasound frames.
+
+The frames are expected under one directory per label, with any number of
+acquisition sessions below it:
+
+    frames/
+        normal/<session>/.../*.png
+        neumonia/<session>/.../*.png
+
+Every frame is decoded as grayscale and resized to 256x256 (as in
+prediction/class_p.py) by a pool of worker processes, and the result is
+written as uint8 chunks of a dataset_store (compressed with --compress), which
+load_data_shared and the Keras scripts read directly. All the frames of a session go to the same split,
+chosen from a hash of the session path, so the split of a frame never changes
+when the dataset is rebuilt.
+
+Each chunk records the frames it holds, so the command is resumable and
+incremental: running it again after an interruption, or after new
+acquisitions were exported, only decodes the frames that are not in the store
+yet, and only writes their chunks. Every batch of chunks is published as a new
+version of the store (see dataset_store.append), so a training run that opened
+the store keeps reading the snapshot it started with.
+
+command line: python ingest_frames.py frames/ ../data/neumonia_dataset_interson.store
+'''
+
+#### Libraries
+# Standard library
+import argparse
+import hashlib
+import itertools
+import multiprocessing
+import os
+
+# Third-party libraries
+import numpy as np
+from scipy import misc
+
+import dataset_store
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+LABELS = {'normal': 0, 'neumonia': 1, '0': 0, '1': 1}
+
+
+def find_frames(frames_dir):
+    """Return the sorted list of `(relative_path, label)` of the frames under
+    `frames_dir`."""
+    frames = []
+    for label_dir in sorted(os.listdir(frames_dir)):
+        if label_dir.lower() not in LABELS:
+            continue
+        label = LABELS[label_dir.lower()]
+        for root, dirs, files in os.walk(os.path.join(frames_dir, label_dir)):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    path = os.path.relpath(os.path.join(root, name), frames_dir)
+                    frames.append((path, label))
+    return frames
+
+def assign_split(path, validation=0.1, test=0.1):
+    """Return the split ('training', 'validation' or 'test') of the frame
+    `path`, decided by a hash of its session directory."""
+    session = os.path.dirname(path)
+    fraction = int(hashlib.sha1(session).hexdigest()[:8], 16) / float(0xffffffff)
+    if fraction < test:
+        return 'test'
+    if fraction < test + validation:
+        return 'validation'
+    return 'training'
+
+_frames_dir = [None]
+
+def _init_worker(frames_dir):
+    _frames_dir[0] = frames_dir
+
+def load_frame(path, size=(256, 256)):
+    """Decode the frame `path` (relative to the frames directory) and return
+    it as a flat uint8 array of `size` pixels, or None if it cannot be read."""
+    try:
+        image = misc.imread(os.path.join(_frames_dir[0], path), mode='L')
+    except (IOError, ValueError):
+        return None
+    return misc.imresize(image, size).reshape(-1)
+
+def ingest(frames_dir, store_dir, processes=None, chunk_size=1000,
+           validation=0.1, test=0.1, codec=None):
+    """Add to `store_dir` every frame under `frames_dir` it does not hold yet,
+    in chunks of at most `chunk_size` frames per split, compressed with
+    `codec` if given. Returns the number of frames added."""
+    done = dataset_store.read_sources(store_dir)
+    todo = [(path, label) for path, label in find_frames(frames_dir)
+            if path not in done]
+    print 'Found %d new frames (%d already in %s)' % (len(todo), len(done), store_dir)
+    if not todo:
+        return 0
+    pending = dict((name, ([], [], [])) for name in dataset_store.SPLITS)
+    added = 0
+    pool = multiprocessing.Pool(processes, _init_worker, (frames_dir,))
+    try:
+        paths = [path for path, label in todo]
+        frames = pool.imap(load_frame, paths, chunksize=16)
+        for (path, label), frame in itertools.izip(todo, frames):
+            if frame is None:
+                print 'Skipping %s: cannot decode it' % path
+                continue
+            split = assign_split(path, validation, test)
+            images, labels, sources = pending[split]
+            images.append(frame)
+            labels.append(label)
+            sources.append(path)
+            if len(images) == chunk_size:
+                added += _flush(store_dir, [split], pending, codec)
+        added += _flush(store_dir, dataset_store.SPLITS, pending, codec)
+    finally:
+        pool.terminate()
+        pool.join()
+    return added
+
+def _flush(store_dir, splits, pending, codec):
+    "Append the pending frames of `splits` to the store as one new version."
+    datasets = [None] * len(dataset_store.SPLITS)
+    names = [None] * len(dataset_store.SPLITS)
+    added = 0
+    for split in splits:
+        images, labels, sources = pending[split]
+        if not images:
+            continue
+        k = dataset_store.SPLITS.index(split)
+        datasets[k] = (np.array(images, dtype='uint8'), np.array(labels, dtype='int32'))
+        names[k] = sources
+        added += len(images)
+        pending[split] = ([], [], [])
+    if added:
+        version = dataset_store.append(store_dir, datasets, names, codec=codec)
+        print 'Wrote %d frames (version %d)' % (added, version)
+    return added
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Decode and resize exported frames into a dataset store.')
+    parser.add_argument('frames_dir')
+    parser.add_argument('store_dir')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='frames per chunk')
+    parser.add_argument('--compress', action='store_true',
+                        help='compress the frames (zlib)')
+    parser.add_argument('--validation', type=float, default=0.1,
+                        help='fraction of the sessions used for validation')
+    parser.add_argument('--test', type=float, default=0.1,
+                        help='fraction of the sessions used for testing')
+    args = parser.parse_args()
+    added = ingest(args.frames_dir, args.store_dir, args.processes,
+                   args.chunk_size, args.validation, args.test,
+                   'zlib' if args.compress else None)
+    print 'Added %d frames to %s' % (added, args.store_dir)
@@ -0,0 +1,65 @@
+'''
+test_dataset_store.py: Every version of a store stays readable while it is
+appended to and rewritten.
+
+command line: python -m unittest test_dataset_store
+'''
+
+#### Libraries
+# Standard library
+import shutil
+import tempfile
+import unittest
+
+# Third-party libraries
+import numpy as np
+
+import dataset_store
+
+
+def splits(seed, rows=(6, 3, 2)):
+    "Return random `(training, validation, test)` splits of `rows` frames."
+    rng = np.random.RandomState(seed)
+    return [(rng.randint(0, 256, (n, 16)).astype('uint8'),
+             rng.randint(0, 2, n).astype('int32')) for n in rows]
+
+
+class VersionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp(suffix='.store')
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def check_versions(self, expected):
+        self.assertEqual(dataset_store.versions(self.store_dir), range(len(expected)))
+        for version, datasets in enumerate(expected):
+            opened = dataset_store.open_store(self.store_dir, version=version)
+            for (x, y), (data_x, data_y) in zip(opened, datasets):
+                np.testing.assert_array_equal(np.asarray(x), data_x)
+                np.testing.assert_array_equal(y, data_y)
+
+    def test_append_after_rewrite(self):
+        first, second, rewritten, third = splits(0), splits(1), splits(2), splits(3)
+        expected = []
+        dataset_store.append(self.store_dir, first)
+        expected.append(first)
+        dataset_store.append(self.store_dir, second)
+        expected.append([(np.concatenate([a[0], b[0]]), np.concatenate([a[1], b[1]]))
+                         for a, b in zip(first, second)])
+        dataset_store.write_store(self.store_dir, rewritten, x_dtype='uint8')
+        expected.append(rewritten)
+        dataset_store.append(self.store_dir, third)
+        expected.append([(np.concatenate([a[0], b[0]]), np.concatenate([a[1], b[1]]))
+                         for a, b in zip(rewritten, third)])
+        # a split left out of an append keeps its chunks
+        dataset_store.append_chunk(self.store_dir, 'test', *third[2])
+        expected.append(expected[-1][:2] + [
+            (np.concatenate([expected[-1][2][0], third[2][0]]),
+             np.concatenate([expected[-1][2][1], third[2][1]]))])
+        self.check_versions(expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+'''
+augmentation.py: Elastic deformations generated while training.
+
+Instead of storing precomputed deformations (the *_elDeform_* datasets), every
+minibatch is deformed again when it is read, so each epoch sees new images and
+the dataset on disk holds only the original frames. The deformation follows
+Simard et al., "Best Practices for Convolutional Neural Networks Applied to
+Visual Document Analysis", 2003: a random displacement field smoothed with a
+Gaussian of width `sigma` and scaled by `alpha`. The displacement fields of a
+whole batch are drawn and smoothed at once, and the batch is resampled with a
+single map_coordinates call.
+
+The work is done by a pool of worker processes that read the frames straight
+from the (memory-mapped) source array they inherit, so only row indices and the
+deformed frames cross process boundaries. The same ElasticDeformer feeds
+Network.SGD (through streaming.ChunkStream) and Keras' fit_generator.
+'''
+
+#### Libraries
+# Standard library
+import collections
+import multiprocessing
+
+# Third-party libraries
+import numpy as np
+from scipy import ndimage
+
+
+def elastic_deform(images, alpha, sigma, rng, image_shape=(256, 256)):
+    """Return a deformed copy of `images`, an array of frames whose rows hold
+    `image_shape` pixels (flattened or not). Integer images are rounded and
+    clipped back to their dtype."""
+    images = np.asarray(images)
+    frames = images.reshape((-1,) + tuple(image_shape)).astype('float32')
+    shape = frames.shape
+    smooth = (0, sigma, sigma)
+    dy = ndimage.gaussian_filter(rng.uniform(-1, 1, shape), smooth, mode='constant') * alpha
+    dx = ndimage.gaussian_filter(rng.uniform(-1, 1, shape), smooth, mode='constant') * alpha
+    batch, rows, cols = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]),
+                                    np.arange(shape[2]), indexing='ij')
+    deformed = ndimage.map_coordinates(frames, [batch, rows + dy, cols + dx],
+                                       order=1, mode='reflect')
+    if images.dtype.kind in 'iu':
+        info = np.iinfo(images.dtype)
+        deformed = np.clip(np.rint(deformed), info.min, info.max)
+    return deformed.astype(images.dtype).reshape(images.shape)
+
+#### Worker processes
+_worker = {}
+
+def _init_worker(source, alpha, sigma, image_shape):
+    _worker.update(source=source, alpha=alpha, sigma=sigma, image_shape=image_shape)
+
+def _deform_task(task):
+    rows, seed = task
+    return elastic_deform(_worker['source'][rows], _worker['alpha'],
+                          _worker['sigma'], np.random.RandomState(seed),
+                          _worker['image_shape'])
+
+
+class ElasticDeformer(object):
+
+    def __init__(self, alpha=34.0, sigma=4.0, image_shape=(256, 256),
+                 processes=None, rows_per_task=16, seed=None):
+        """`alpha` and `sigma` set the strength and smoothness of the
+        deformation, in pixels. `processes` is the size of the worker pool
+        (one per core by default) and `rows_per_task` the number of frames each
+        worker deforms per call.
+
+        """
+        self.alpha = alpha
+        self.sigma = sigma
+        self.image_shape = tuple(image_shape)
+        self.processes = processes
+        self.rows_per_task = rows_per_task
+        self.rng = np.random.RandomState(seed)
+        self.pool = None
+        self.source = None
+
+    def start(self, source):
+        """Start the worker pool on the frames `source`. The workers are
+        forked, so a memory-mapped `source` is shared rather than copied. Call
+        this before starting any thread."""
+        self.close()
+        self.source = source
+        self.pool = multiprocessing.Pool(
+            self.processes, _init_worker,
+            (source, self.alpha, self.sigma, self.image_shape))
+
+    def deform(self, rows, out):
+        """Write deformed copies of the frames `source[rows]` (a slice or an
+        index array) into `out`, using every worker."""
+        rows = np.arange(len(self.source))[rows]
+        tasks = [(rows[k:k + self.rows_per_task], self.rng.randint(2**31 - 1))
+                 for k in xrange(0, len(rows), self.rows_per_task)]
+        start = 0
+        for frames in self.pool.imap(_deform_task, tasks):
+            out[start:start + len(frames)] = frames
+            start += len(frames)
+
+    def batches(self, labels, batch_size, shuffle=True):
+        """Yield `(images, labels)` minibatches of deformed frames forever,
+        in a new order each epoch, as expected by Keras' fit_generator. At
+        most two batches per worker are computed ahead."""
+        ahead = 2 * (self.processes or multiprocessing.cpu_count())
+        while True:
+            n = len(labels)
+            order = self.rng.permutation(n) if shuffle else np.arange(n)
+            pending = collections.deque()
+            for k in xrange(0, n, batch_size):
+                task = (order[k:k + batch_size], self.rng.randint(2**31 - 1))
+                pending.append((task[0], self.pool.apply_async(_deform_task, (task,))))
+                if len(pending) >= ahead:
+                    rows, result = pending.popleft()
+                    yield result.get(), labels[rows]
+            while pending:
+                rows, result = pending.popleft()
+                yield result.get(), labels[rows]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
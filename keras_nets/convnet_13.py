@@ -5,6 +5,7 @@ import numpy as np
 import h5py
 import keras
 import cPickle
+import dataset_store
 from keras.optimizers import SGD
 from keras.datasets import mnist
 from keras.models import Sequential
@@ -23,26 +24,24 @@ def F1_score(y_true,y_pred):
 def load_data_p(number):
 	'''
 	This code lodes the data from the Pneumonia
-	dataset into the model
+	dataset into the model. A store written with
+	dataset_store.py --uint8 is memory-mapped and keeps
+	the images as uint8; they are cast as each batch is fed to the model.
+	A compressed store is decompressed once, in parallel threads.
+	With the fold store, the images are views that gather
+	the frames of fold `number` from the images shared by every fold
 	'''
-	
-	f = open('neumonia_dataset_interson_keras_alldata10_{0}.pkl'.format(number),'rb')
-	data = cPickle.load(f)
-	f.close()
-	training_data = data[0]
-	validation_data = data[1]
-	test_data = data[2]
-
-	label_t = training_data[1]
-	data_t = training_data[0]
-
-	label_v = validation_data[1]
-	data_v = validation_data[0]
-	
-	label_tt = test_data[1]
-	data_tt = test_data[0]
-
-	return (data_t,label_t),(data_v,label_v),(data_tt,label_tt)
+	folds = 'neumonia_dataset_interson_keras_alldata10.folds'
+	if dataset_store.is_store(folds):
+		return tuple(dataset_store.open_fold(folds, number))
+	name = 'neumonia_dataset_interson_keras_alldata10_{0}'.format(number)
+	if dataset_store.is_store(name + '.store'):
+		return tuple(dataset_store.open_store(name + '.store', decode=True))
+	# the pickle is converted (and reshaped for Convolution2D) once into its
+	# cache, and mapped on later runs
+	store = dataset_store.cached_store(name + '.pkl', x_dtype='float32',
+	                                   row_shape=(1, img_rows, img_cols))
+	return tuple(dataset_store.open_store(store, decode=True))
 
 
 class LossHistory(keras.callbacks.Callback):
@@ -79,9 +78,8 @@ for jk in xrange(9):
 	X_val = X_val.reshape(X_val.shape[0], 1, img_rows, img_cols)
 	X_test = X_test.reshape(X_test.shape[0], 1, img_rows, img_cols)
 
-	X_train = X_train.astype('float32')
-	X_val = X_val.astype('float32')
-	X_test = X_test.astype('float32')
+	# no astype('float32') copies: uint8 images are cast batch by batch
+	# when Keras feeds them to the compiled model
 
 
 	print('X_train shape:', X_train.shape)
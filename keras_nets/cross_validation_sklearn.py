@@ -7,8 +7,9 @@ import numpy as np
 
 
 import cPickle
+import dataset_store
 from keras.models import Sequential
-from keras.layers import Dense, Dropout, Activation, Flatten
+from keras.layers import Dense, Dropout, Activation, Flatten, Lambda
 from keras.layers import Convolution2D, MaxPooling2D
 from keras.utils import np_utils
 from keras.wrappers.scikit_learn import KerasClassifier
@@ -21,26 +22,22 @@ from sklearn import preprocessing
 def load_data_p(number):
 	'''
 	This code lodes the data from the Pneumonia
-	dataset into the model
+	dataset into the model. A store written with
+	dataset_store.py --uint8 is memory-mapped and keeps
+	the images as uint8; they are cast as each batch is fed to the model.
+	A compressed store is decompressed once, in parallel threads.
+	With the fold store, the images are views that gather
+	the frames of fold `number` from the images shared by every fold
 	'''
-	
-	f = open('neumonia_dataset_interson_keras_alldata10_{0}.pkl'.format(number),'rb')
-	data = cPickle.load(f)
-	f.close()
-	training_data = data[0]
-	validation_data = data[1]
-	test_data = data[2]
-
-	label_t = training_data[1]
-	data_t = training_data[0]
-
-	label_v = validation_data[1]
-	data_v = validation_data[0]
-	
-	label_tt = test_data[1]
-	data_tt = test_data[0]
-
-	return (data_t,label_t),(data_v,label_v),(data_tt,label_tt)
+	folds = 'neumonia_dataset_interson_keras_alldata10.folds'
+	if dataset_store.is_store(folds):
+		return tuple(dataset_store.open_fold(folds, number))
+	name = 'neumonia_dataset_interson_keras_alldata10_{0}'.format(number)
+	if dataset_store.is_store(name + '.store'):
+		return tuple(dataset_store.open_store(name + '.store', decode=True))
+	# the pickle is converted once into its cache, and mapped on later runs
+	store = dataset_store.cached_store(name + '.pkl', x_dtype='float32')
+	return tuple(dataset_store.open_store(store, decode=True))
 
 
 
@@ -56,13 +53,7 @@ number_db = 9
 X_train = X_train.reshape(X_train.shape[0], 1, img_rows, img_cols)
 X_val = X_val.reshape(X_val.shape[0], 1, img_rows, img_cols)
 X_test = X_test.reshape(X_test.shape[0], 1, img_rows, img_cols)
-X_train = X_train.astype('float32')
-X_val = X_val.astype('float32')
-X_test = X_test.astype('float32')
-
-X_train /= 255
-X_test /= 255
-X_val /= 255
+# the images stay uint8; the scaling to [0,1] is the first layer of the model
 
 print('X_train shape:', X_train.shape)
 print(X_train.shape[0], 'train samples')
@@ -79,9 +70,10 @@ def make_model(dropout, nb_filters, nb_conv, nb_pool,weight_initiation,activatio
     '''
     model = Sequential()
 
+    model.add(Lambda(lambda x: x / 255., input_shape=(1, img_rows, img_cols)))
     model.add(Convolution2D(8, 8, 8,
 		                border_mode='valid',
-		                input_shape=(1, img_rows, img_cols),subsample = (4,4),W_regularizer=l1l2(l1 = l1_reg,l2=l2_reg),b_regularizer=l1l2(l1 = l1_reg,l2=l2_reg),init=weight_initiation))
+		                subsample = (4,4),W_regularizer=l1l2(l1 = l1_reg,l2=l2_reg),b_regularizer=l1l2(l1 = l1_reg,l2=l2_reg),init=weight_initiation))
     model.add(Activation(activation_function))
     model.add(MaxPooling2D(pool_size=(nb_pool, nb_pool)))
     model.add(Dropout(dropout))
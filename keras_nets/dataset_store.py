@@ -0,0 +1,770 @@
+'''
+dataset_store.py: On-disk format for the Pneumonia datasets.
+
+A store is a directory with one raw array per split (images and labels) plus a
+small JSON header describing the dtype and shape of every array. The arrays are
+opened with np.memmap, so loading a store does not read the images into memory
+and does not need a second copy to change the dtype.
+
+    store/
+        header.json
+        training_x.raw    training_y.raw
+        validation_x.raw  validation_y.raw
+        test_x.raw        test_y.raw
+
+A split can also be a list of chunks, each with its own image and label files
+(`append`, `append_chunk`). The chunks of a split are read as one array
+through a ChunkedArray. Chunk files are never rewritten: adding frames writes
+new chunks (named after the version that adds them) and then a new version of
+the header, so the I/O of an append is the size of the new data, not of the
+whole dataset.
+
+Every version of the header is kept as manifest.<version>.json, and
+header.json (the current version) is replaced atomically. A reader opens one
+version and keeps seeing it while other versions are appended (or the store
+is rewritten, with new files), and `open_store(store_dir, version=k)` reopens
+an older snapshot.
+
+    store/
+        header.json  manifest.00000.json  manifest.00001.json ...
+        training_00000_x.raw  training_00000_y.raw  training_00000.sources
+        ...
+
+To add the splits of a new (training, validation, test) pickle to a store:
+
+command line: python dataset_store.py --append ../data/neumonia_dataset_interson.store new_session.pkl
+
+The images can be stored as uint8, a quarter of the bytes of float32; the
+networks cast them to floatX inside the compiled graph (see Network in
+network_interson.py).
+
+The images can also be compressed (--compress, codec 'zlib'): the black
+background around the imaging sector makes the frames shrink to a fraction of
+their size, so fewer bytes are read from disk or the network filesystem each
+epoch. A compressed array is cut in blocks of COMPRESSED_BLOCK_ROWS rows that
+are compressed independently; reading rows decompresses the blocks they span
+in parallel threads into a preallocated array (see CompressedArray and
+`read_rows`).
+
+To convert one of the old pickles (add --uint8 to store 8-bit pixels):
+
+command line: python dataset_store.py ../data/neumonia_dataset_interson_elDeform_0_2.pkl
+
+Pickles that are not converted by hand are converted once by `cached_store`,
+which keeps the prepared arrays (dtype, row shape) in a cache next to
+the pickle, keyed by a hash of the pickle's contents and of the preparation,
+so later runs map them instead of unpickling and converting again:
+
+    neumonia_dataset_interson_elDeform_0_2.cache/
+        index.json
+        <key>/  (a store)
+
+The cross-validation folds used by keras_nets are kept as a fold store instead:
+every distinct frame is written once, and each fold is three small arrays of
+frame indices. `open_fold` returns views over the shared images that gather
+only the rows that are asked for.
+
+    folds/
+        header.json
+        images.raw  labels.raw
+        fold1_training.idx  fold1_validation.idx  fold1_test.idx
+        ...
+
+command line: python dataset_store.py --uint8 --compress --folds neumonia_dataset_interson_keras_alldata10.folds neumonia_dataset_interson_keras_alldata10_*.pkl
+'''
+
+#### Libraries
+# Standard library
+import argparse
+import cPickle
+import errno
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sys
+import zlib
+from multiprocessing.pool import ThreadPool
+
+# Third-party libraries
+import numpy as np
+
+
+FORMAT_VERSION = 1
+HEADER_NAME = 'header.json'
+MANIFEST_NAME = 'manifest.%05d.json'
+LOCK_NAME = 'append.lock'
+SPLITS = ['training', 'validation', 'test']
+# Rows written per block when the dtype has to be converted, so the
+# conversion never holds a second copy of a whole split.
+BLOCK_ROWS = 1024
+# Rows per independently compressed block: 4MB of 256x256 uint8 frames.
+COMPRESSED_BLOCK_ROWS = 64
+COMPRESS_LEVEL = 6
+CODECS = ['zlib']
+# Threads decompressing blocks (None is one per core).
+DECODE_THREADS = None
+
+
+def is_store(path):
+    "Return True if `path` is a directory written by `write_store`."
+    return os.path.isfile(os.path.join(path, HEADER_NAME))
+
+def default_store_name(filename):
+    "Return the store directory used for the pickle `filename`."
+    root, ext = os.path.splitext(filename)
+    return root + '.store'
+
+def _convert(block, dtype, name):
+    """Return `block` as `dtype`. Converting to an integer dtype raises a
+    ValueError unless every value is kept exactly (e.g. float images that
+    hold 0-255 pixel values stored as uint8)."""
+    if block.dtype == dtype:
+        return block
+    converted = block.astype(dtype)
+    if dtype.kind in 'iu' and not np.array_equal(converted, block):
+        raise ValueError('%s cannot be stored as %s without loss' %
+                         (name, dtype.name))
+    return converted
+
+class _CompressedWriter(object):
+    """Write rows to the file `f` as independently compressed blocks of
+    COMPRESSED_BLOCK_ROWS rows, keeping the byte offset of every block."""
+
+    def __init__(self, f):
+        self.f = f
+        self.pending = []
+        self.rows = 0
+        self.offsets = [0]
+
+    def write(self, rows):
+        self.pending.append(np.ascontiguousarray(rows))
+        self.rows += len(rows)
+        while self.rows >= COMPRESSED_BLOCK_ROWS:
+            self._flush(COMPRESSED_BLOCK_ROWS)
+
+    def _flush(self, count):
+        rows = np.concatenate(self.pending)
+        block = zlib.compress(rows[:count].tostring(), COMPRESS_LEVEL)
+        self.f.write(block)
+        self.offsets.append(self.offsets[-1] + len(block))
+        self.pending = [rows[count:]]
+        self.rows -= count
+
+    def close(self):
+        "Write the last block and return the header fields of the array."
+        if self.rows:
+            self._flush(self.rows)
+        return {'codec': 'zlib', 'block_rows': COMPRESSED_BLOCK_ROWS,
+                'offsets': self.offsets}
+
+def _write_array(path, data, dtype, codec=None):
+    """Write `data` to `path` as raw bytes of type `dtype` (compressed with
+    `codec`, if any) and return the header entry describing it."""
+    data = np.asarray(data)
+    dtype = np.dtype(dtype)
+    if codec is not None and codec not in CODECS:
+        raise ValueError('Unknown codec %r' % codec)
+    entry = {'file': os.path.basename(path), 'dtype': dtype.str,
+             'shape': list(data.shape)}
+    f = open(path, 'wb')
+    try:
+        if codec is None and data.dtype == dtype:
+            np.ascontiguousarray(data).tofile(f)
+        elif codec is None:
+            for start in xrange(0, data.shape[0], BLOCK_ROWS):
+                _convert(data[start:start + BLOCK_ROWS], dtype,
+                         os.path.basename(path)).tofile(f)
+        else:
+            writer = _CompressedWriter(f)
+            for start in xrange(0, data.shape[0], BLOCK_ROWS):
+                writer.write(_convert(data[start:start + BLOCK_ROWS], dtype,
+                                      os.path.basename(path)))
+            entry.update(writer.close())
+    finally:
+        f.close()
+    return entry
+
+def _write_header(store_dir, header, name=HEADER_NAME):
+    "Write `header` last and atomically, so a half-written store is never read."
+    tmp_name = os.path.join(store_dir, name + '.tmp')
+    f = open(tmp_name, 'w')
+    json.dump(header, f, indent=1, sort_keys=True)
+    f.close()
+    os.rename(tmp_name, os.path.join(store_dir, name))
+
+def _commit(store_dir, header):
+    """Publish `header` as a new version: its manifest is written first and
+    header.json is then switched to it in one rename."""
+    header['version'] = header.get('version', -1) + 1
+    _write_header(store_dir, header, MANIFEST_NAME % header['version'])
+    _write_header(store_dir, header)
+
+def write_store(store_dir, datasets, x_dtype='float32', y_dtype='int32',
+                codec=None):
+    """Write the `(training, validation, test)` tuple `datasets`, each one an
+    `(images, labels)` pair, into the directory `store_dir`. The images are
+    compressed with `codec` ('zlib'), if given.
+
+    The header is written last, so a store interrupted half way is never
+    mistaken for a complete one. Rewriting an existing store writes new
+    files and publishes them as its next version, like `append`: readers of
+    the older versions keep their files, which are left on disk.
+    """
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    lock = _lock(store_dir)
+    try:
+        header = {'format': FORMAT_VERSION, 'splits': {}}
+        suffix = ''
+        if is_store(store_dir):
+            header['version'] = read_header(store_dir).get('version', -1)
+            suffix = '_v%05d' % (header['version'] + 1)
+        for name, (data_x, data_y) in zip(SPLITS, datasets):
+            prefix = os.path.join(store_dir, name + suffix)
+            header['splits'][name] = {
+                'x': _write_array(prefix + '_x.raw', data_x, x_dtype, codec),
+                'y': _write_array(prefix + '_y.raw', data_y, y_dtype)}
+        _commit(store_dir, header)
+    finally:
+        os.remove(lock)
+    return store_dir
+
+def read_header(store_dir, version=None):
+    """Return the parsed header of the store `store_dir`: the current one, or
+    the manifest of `version`."""
+    name = HEADER_NAME if version is None else MANIFEST_NAME % version
+    f = open(os.path.join(store_dir, name), 'r')
+    header = json.load(f)
+    f.close()
+    if header.get('format') != FORMAT_VERSION:
+        raise ValueError('Unsupported dataset store format %r in %s' %
+                         (header.get('format'), store_dir))
+    return header
+
+def _open_array(store_dir, entry, mode):
+    shape = tuple(entry['shape'])
+    if shape[0] == 0:
+        return np.zeros(shape, dtype=entry['dtype'])
+    if entry.get('codec'):
+        return CompressedArray(os.path.join(store_dir, entry['file']), entry)
+    return np.memmap(os.path.join(store_dir, entry['file']),
+                     dtype=entry['dtype'], mode=mode, shape=shape)
+
+def _open_split(store_dir, split, mode):
+    "Return the `(images, labels)` arrays of a split entry of the header."
+    if 'chunks' not in split:
+        return (_open_array(store_dir, split['x'], mode),
+                _open_array(store_dir, split['y'], mode))
+    chunks = [(_open_array(store_dir, chunk['x'], mode),
+               _open_array(store_dir, chunk['y'], mode))
+              for chunk in split['chunks']]
+    if not chunks:
+        return np.zeros((0,), dtype='uint8'), np.zeros((0,), dtype='int32')
+    if len(chunks) == 1:
+        return chunks[0]
+    return (ChunkedArray([x for x, y in chunks]),
+            np.concatenate([y for x, y in chunks]))
+
+
+_decode_pool = {}
+
+def _decode_map(function, items):
+    """Run `function` over `items` in the decoding threads. zlib releases
+    the GIL, so the blocks are decompressed in parallel. A process forked
+    from this one (a deformation worker) starts its own threads."""
+    pid = os.getpid()
+    if pid not in _decode_pool:
+        _decode_pool.clear()
+        _decode_pool[pid] = ThreadPool(DECODE_THREADS)
+    return _decode_pool[pid].map(function, items)
+
+def read_rows(data, start, stop, out):
+    """Copy the rows `start:stop` of `data` into the preallocated array
+    `out`, decompressing them there when `data` is compressed."""
+    if hasattr(data, 'read_into'):
+        data.read_into(start, stop, out)
+    else:
+        out[...] = data[start:stop]
+    return out
+
+def _index_array(key, length):
+    "Return `key` (a slice, a boolean mask or indices) as an index array."
+    if isinstance(key, slice):
+        return np.arange(*key.indices(length))
+    key = np.asarray(key)
+    if key.dtype == np.bool_:
+        key = np.flatnonzero(key)
+    return np.where(key < 0, key + length, key)
+
+
+class CompressedArray(object):
+    """An array written with a codec, as independently compressed blocks of
+    rows. It has the `shape`, `dtype`, `len` and indexing of an array;
+    reading rows decompresses only the blocks that hold them, in parallel."""
+
+    def __init__(self, path, entry):
+        self.dtype = np.dtype(entry['dtype'])
+        self.shape = tuple(entry['shape'])
+        self.ndim = len(self.shape)
+        self.block_rows = entry['block_rows']
+        self.offsets = entry['offsets']
+        self.data = np.memmap(path, dtype='uint8', mode='r')
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _decode(self, block):
+        start, stop = self.offsets[block], self.offsets[block + 1]
+        rows = zlib.decompress(buffer(self.data, start, stop - start))
+        return np.frombuffer(rows, dtype=self.dtype).reshape((-1,) + self.shape[1:])
+
+    def read_into(self, start, stop, out):
+        "Decompress the rows `start:stop` into `out`."
+        size = self.block_rows
+        def copy(block):
+            lo = max(start, block * size)
+            hi = min(stop, (block + 1) * size)
+            out[lo - start:hi - start] = self._decode(block)[lo - block * size:hi - block * size]
+        if start < stop:
+            _decode_map(copy, range(start // size, (stop - 1) // size + 1))
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long, np.integer)):
+            if key < 0:
+                key += len(self)
+            return self._decode(key // self.block_rows)[key % self.block_rows].copy()
+        if isinstance(key, slice) and key.step in (None, 1):
+            start, stop, step = key.indices(len(self))
+            out = np.empty((max(stop - start, 0),) + self.shape[1:], dtype=self.dtype)
+            return self.read_into(start, stop, out)
+        key = _index_array(key, len(self))
+        blocks = key // self.block_rows
+        rows = np.empty(key.shape + self.shape[1:], dtype=self.dtype)
+        def gather(block):
+            mask = blocks == block
+            rows[mask] = self._decode(block)[key[mask] - block * self.block_rows]
+        _decode_map(gather, np.unique(blocks))
+        return rows
+
+    def __array__(self, dtype=None):
+        rows = self[:]
+        return rows if dtype is None else rows.astype(dtype)
+
+class ChunkedArray(object):
+    """The chunks of a split (memory-mapped or compressed arrays with the
+    same row shape) seen as one array. Indexing with an integer, a slice or
+    an index array reads only the rows asked for, and a slice inside one
+    memory-mapped chunk is a view."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.offsets = np.cumsum([0] + [len(chunk) for chunk in chunks])
+        self.dtype = chunks[0].dtype
+        self.shape = (int(self.offsets[-1]),) + tuple(chunks[0].shape[1:])
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long, np.integer)):
+            if key < 0:
+                key += len(self)
+            k = np.searchsorted(self.offsets, key, 'right') - 1
+            return self.chunks[k][key - self.offsets[k]]
+        if isinstance(key, slice) and key.step in (None, 1):
+            start, stop, step = key.indices(len(self))
+            k = np.searchsorted(self.offsets, start, 'right') - 1
+            if start < stop and stop <= self.offsets[k + 1]:
+                return self.chunks[k][start - self.offsets[k]:stop - self.offsets[k]]
+            out = np.empty((max(stop - start, 0),) + self.shape[1:], dtype=self.dtype)
+            return self.read_into(start, stop, out)
+        key = _index_array(key, len(self))
+        owner = np.searchsorted(self.offsets, key, 'right') - 1
+        rows = np.empty(key.shape + self.shape[1:], dtype=self.dtype)
+        for k in np.unique(owner):
+            mask = owner == k
+            rows[mask] = self.chunks[k][key[mask] - self.offsets[k]]
+        return rows
+
+    def read_into(self, start, stop, out):
+        "Copy the rows `start:stop` into `out`, chunk by chunk."
+        for k, chunk in enumerate(self.chunks):
+            lo = max(start - self.offsets[k], 0)
+            hi = min(stop - self.offsets[k], len(chunk))
+            if lo < hi:
+                at = self.offsets[k] + lo - start
+                read_rows(chunk, lo, hi, out[at:at + hi - lo])
+        return out
+
+    def __array__(self, dtype=None):
+        rows = self[:]
+        return rows if dtype is None else rows.astype(dtype)
+
+def is_compressed(data):
+    "Return True if reading rows of `data` decompresses them."
+    if isinstance(data, ChunkedArray):
+        return any(is_compressed(chunk) for chunk in data.chunks)
+    return isinstance(data, CompressedArray)
+
+def _lock(store_dir):
+    "Take the append lock of `store_dir`; only one writer may append at a time."
+    name = os.path.join(store_dir, LOCK_NAME)
+    try:
+        os.close(os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+        raise IOError('%s is locked by another writer (remove %s if none is '
+                      'running)' % (store_dir, name))
+    return name
+
+def append(store_dir, datasets, sources=None, x_dtype=None, y_dtype='int32',
+           codec=None):
+    """Add the `(training, validation, test)` tuple `datasets` to the end of
+    the splits of `store_dir` as new chunks, creating the store if needed.
+    A split given as None (or with no rows) is left as it is. The images are
+    stored as `x_dtype` and compressed with `codec`, by default the dtype and
+    codec of the chunks already in the split. `sources` is an
+    optional tuple with, for each split, the names of the rows (the frame
+    files they came from), kept next to the chunk.
+
+    Only the new chunks and a new manifest are written, and the new version
+    becomes visible all at once when header.json is switched to it, so an
+    interrupted append leaves the store as it was and readers never see half
+    of one. Returns the new version.
+    """
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    lock = _lock(store_dir)
+    try:
+        if is_store(store_dir):
+            header = read_header(store_dir)
+        else:
+            header = {'format': FORMAT_VERSION,
+                      'splits': dict((name, {'chunks': []}) for name in SPLITS)}
+        for k, name in enumerate(SPLITS):
+            if datasets[k] is None or len(datasets[k][1]) == 0:
+                continue
+            data_x, data_y = datasets[k]
+            entry = header['splits'][name]
+            if 'chunks' not in entry:
+                entry = header['splits'][name] = {'chunks': [entry]}
+            dtype, chunk_codec = x_dtype, codec
+            if entry['chunks']:
+                # new chunks are written like the first one by default
+                dtype = dtype or entry['chunks'][0]['x']['dtype']
+                chunk_codec = chunk_codec or entry['chunks'][0]['x'].get('codec')
+            # named after the version that adds it, so no later append or
+            # rewrite reuses the files of a chunk an older manifest points to
+            prefix = '%s_%05d' % (name, header.get('version', -1) + 1)
+            chunk = {
+                'x': _write_array(os.path.join(store_dir, prefix + '_x.raw'), data_x,
+                                  dtype or np.asarray(data_x).dtype, chunk_codec),
+                'y': _write_array(os.path.join(store_dir, prefix + '_y.raw'),
+                                  data_y, y_dtype)}
+            if sources is not None and sources[k] is not None:
+                f = open(os.path.join(store_dir, prefix + '.sources'), 'w')
+                f.write(''.join(source + '\n' for source in sources[k]))
+                f.close()
+                chunk['sources'] = prefix + '.sources'
+            entry['chunks'].append(chunk)
+        _commit(store_dir, header)
+    finally:
+        os.remove(lock)
+    return header['version']
+
+def append_chunk(store_dir, split, data_x, data_y, sources=None,
+                 x_dtype=None, y_dtype='int32', codec=None):
+    """Add `(data_x, data_y)` to the end of the split `split` as a new chunk
+    (see `append`). Returns the new version."""
+    datasets = [None] * len(SPLITS)
+    datasets[SPLITS.index(split)] = (data_x, data_y)
+    names = None
+    if sources is not None:
+        names = [None] * len(SPLITS)
+        names[SPLITS.index(split)] = sources
+    return append(store_dir, datasets, names, x_dtype=x_dtype, y_dtype=y_dtype,
+                  codec=codec)
+
+def versions(store_dir):
+    "Return the sorted list of the versions of `store_dir` that can be opened."
+    names = glob.glob(os.path.join(store_dir, 'manifest.*.json'))
+    return sorted(int(os.path.basename(name).split('.')[1]) for name in names)
+
+def read_sources(store_dir):
+    "Return the set of source names recorded by `append_chunk` in the store."
+    sources = set()
+    if not is_store(store_dir):
+        return sources
+    for split in read_header(store_dir)['splits'].values():
+        for chunk in split.get('chunks', []):
+            if 'sources' in chunk:
+                f = open(os.path.join(store_dir, chunk['sources']), 'r')
+                sources.update(line.rstrip('\n') for line in f)
+                f.close()
+    return sources
+
+def open_store(store_dir, mode='r', version=None, decode=False):
+    """Return `[(training_x, training_y), (validation_x, validation_y),
+    (test_x, test_y)]` as memory-mapped arrays (CompressedArrays for
+    compressed images, ChunkedArrays for splits made of several chunks).
+    Pages are read from disk only when they are touched. The arrays are
+    those of the current version of the store, or of `version`, and do not
+    change when chunks are appended later.
+    With `decode`, compressed images are decompressed into memory at once,
+    for readers that draw rows at random, such as Keras' fit."""
+    header = read_header(store_dir, version)
+    if 'folds' in header:
+        raise ValueError('%s is a fold store, open it with open_fold' % store_dir)
+    datasets = []
+    for name in SPLITS:
+        data_x, data_y = _open_split(store_dir, header['splits'][name], mode)
+        if decode and is_compressed(data_x):
+            data_x = np.asarray(data_x)
+        datasets.append((data_x, data_y))
+    return datasets
+
+def convert_pickle(filename, store_dir=None, x_dtype='float32', y_dtype='int32',
+                   codec=None):
+    "Convert a `(training, validation, test)` pickle into a store."
+    if store_dir is None:
+        store_dir = default_store_name(filename)
+    f = open(filename, 'rb')
+    datasets = cPickle.load(f)
+    f.close()
+    return write_store(store_dir, datasets, x_dtype=x_dtype, y_dtype=y_dtype,
+                       codec=codec)
+
+#### Cache of prepared arrays
+def default_cache_name(filename):
+    "Return the cache directory used for the pickle `filename`."
+    root, ext = os.path.splitext(filename)
+    return root + '.cache'
+
+def file_digest(filename):
+    "Return the sha1 of the contents of `filename`, read 1MB at a time."
+    digest = hashlib.sha1()
+    f = open(filename, 'rb')
+    for block in iter(lambda: f.read(1 << 20), ''):
+        digest.update(block)
+    f.close()
+    return digest.hexdigest()
+
+def _read_index(cache_dir):
+    try:
+        f = open(os.path.join(cache_dir, 'index.json'), 'r')
+    except IOError:
+        return {}
+    index = json.load(f)
+    f.close()
+    return index
+
+def cached_store(filename, x_dtype='float32', y_dtype='int32', row_shape=None,
+                 codec=None):
+    """Return a store holding the `(training, validation, test)` pickle
+    `filename` prepared as asked: images of `x_dtype` with rows reshaped to
+    `row_shape`, if given (e.g. (1, rows, columns) for Keras). The store is
+    built the first time and found again in the cache of `filename` by the
+    sha1 of the pickle's contents and of the preparation. The contents are
+    hashed again only when the size or the modification time of the pickle
+    changed, and when they did change every entry made from the old contents
+    is removed.
+    """
+    cache_dir = default_cache_name(filename)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    index = _read_index(cache_dir)
+    stat = os.stat(filename)
+    source = index.get('source', {})
+    if source.get('size') == stat.st_size and source.get('mtime') == stat.st_mtime:
+        digest = source['sha1']
+    else:
+        digest = file_digest(filename)
+        if digest != source.get('sha1'):
+            for name in os.listdir(cache_dir):
+                if os.path.isdir(os.path.join(cache_dir, name)):
+                    shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+            index = {}
+        index['source'] = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                           'sha1': digest}
+        _write_header(cache_dir, index, 'index.json')
+    transform = {'x_dtype': np.dtype(x_dtype).str, 'y_dtype': np.dtype(y_dtype).str,
+                 'row_shape': list(row_shape) if row_shape else None,
+                 'codec': codec}
+    key = hashlib.sha1(digest + json.dumps(transform, sort_keys=True)).hexdigest()[:16]
+    store_dir = os.path.join(cache_dir, key)
+    if is_store(store_dir):
+        return store_dir
+    f = open(filename, 'rb')
+    datasets = cPickle.load(f)
+    f.close()
+    prepared = []
+    for data_x, data_y in datasets:
+        data_x = np.asarray(data_x)
+        if row_shape:
+            data_x = data_x.reshape((len(data_x),) + tuple(row_shape))
+        prepared.append((data_x, data_y))
+    # Built aside and renamed into place, so a concurrent run never maps a
+    # half-written entry.
+    tmp_dir = '%s.tmp%d' % (store_dir, os.getpid())
+    write_store(tmp_dir, prepared, x_dtype=x_dtype, y_dtype=y_dtype, codec=codec)
+    try:
+        os.rename(tmp_dir, store_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not is_store(store_dir):
+            raise
+    return store_dir
+
+#### Cross-validation folds
+class FoldView(object):
+    """Read-only view of the rows `index` of the array `data`. It has the
+    `shape`, `dtype`, `len` and indexing of an array, like Keras' HDF5Matrix,
+    so it can be passed to `fit`, `predict` and `evaluate`; indexing it
+    gathers only the requested rows from the memory-mapped images."""
+
+    def __init__(self, data, index, row_shape=None):
+        self.data = data
+        self.index = index
+        self.row_shape = tuple(row_shape or data.shape[1:])
+        self.dtype = data.dtype
+
+    @property
+    def shape(self):
+        return (len(self.index),) + self.row_shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return self[key[0]][(slice(None),) + key[1:]]
+        rows = self.data[self.index[key]]
+        return rows.reshape(rows.shape[:rows.ndim - self.data.ndim + 1] +
+                            self.row_shape)
+
+    def __array__(self, dtype=None):
+        rows = self[:]
+        return rows if dtype is None else rows.astype(dtype)
+
+    def take(self, indices, axis=0):
+        if axis != 0:
+            raise ValueError('FoldView can only be indexed by example')
+        return self[np.asarray(indices)]
+
+    def reshape(self, *shape):
+        """Return a view with each row reshaped; the first dimension must be
+        the number of rows, as in `X.reshape(X.shape[0], 1, 256, 256)`."""
+        if len(shape) == 1 and isinstance(shape[0], tuple):
+            shape = shape[0]
+        if shape[0] != len(self) or np.prod(shape[1:]) != np.prod(self.row_shape):
+            raise ValueError('cannot reshape %r into %r' % (self.shape, shape))
+        return FoldView(self.data, self.index, shape[1:])
+
+def write_fold_store(store_dir, filenames, x_dtype='uint8', y_dtype='int32',
+                     codec=None):
+    """Build a fold store from the per-fold pickles `filenames` (fold k is
+    `filenames[k-1]`). The pickles are read one at a time, and a frame that
+    appears in several folds is identified by the hash of its pixels and
+    written only once, compressed with `codec` if given."""
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    x_dtype, y_dtype = np.dtype(x_dtype), np.dtype(y_dtype)
+    seen = {}
+    labels = []
+    row_shape = None
+    header = {'format': FORMAT_VERSION, 'folds': {}}
+    images = open(os.path.join(store_dir, 'images.raw'), 'wb')
+    writer = images if codec is None else _CompressedWriter(images)
+    try:
+        for number, filename in enumerate(filenames):
+            f = open(filename, 'rb')
+            datasets = cPickle.load(f)
+            f.close()
+            fold = {}
+            for name, (data_x, data_y) in zip(SPLITS, datasets):
+                data_x = np.asarray(data_x)
+                row_shape = row_shape or data_x.shape[1:]
+                index = np.empty(len(data_x), dtype='int32')
+                for k in xrange(len(data_x)):
+                    row = _convert(data_x[k], x_dtype, filename)
+                    key = hashlib.sha1(row.tostring()).digest()
+                    if key not in seen:
+                        seen[key] = len(labels)
+                        labels.append(data_y[k])
+                        writer.write(row[np.newaxis])
+                    elif labels[seen[key]] != data_y[k]:
+                        raise ValueError('%s: a frame appears with two labels' %
+                                         filename)
+                    index[k] = seen[key]
+                fold[name] = _write_array(os.path.join(
+                    store_dir, 'fold%d_%s.idx' % (number + 1, name)), index, 'int32')
+            header['folds'][str(number + 1)] = fold
+        header['images'] = {'file': 'images.raw', 'dtype': x_dtype.str,
+                            'shape': [len(labels)] + list(row_shape)}
+        if codec is not None:
+            header['images'].update(writer.close())
+    finally:
+        images.close()
+    header['labels'] = _write_array(os.path.join(store_dir, 'labels.raw'),
+                                    np.asarray(labels), y_dtype)
+    _write_header(store_dir, header)
+    return store_dir
+
+def open_fold(store_dir, number):
+    """Return `[(training_x, training_y), (validation_x, validation_y),
+    (test_x, test_y)]` of fold `number`. The images are FoldViews of the
+    shared memory-mapped images and the labels are small arrays. Compressed
+    images are decompressed into memory once, in parallel, since every batch
+    gathers frames from all over the array."""
+    header = read_header(store_dir)
+    images = _open_array(store_dir, header['images'], 'r')
+    if is_compressed(images):
+        images = np.asarray(images)
+    labels = _open_array(store_dir, header['labels'], 'r')
+    fold = header['folds'][str(number)]
+    datasets = []
+    for name in SPLITS:
+        index = np.array(_open_array(store_dir, fold[name], 'r'))
+        datasets.append((FoldView(images, index), np.array(labels[index])))
+    return datasets
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert pickled Pneumonia datasets into dataset stores.')
+    parser.add_argument('--uint8', action='store_true',
+                        help='store the images as 8-bit pixels')
+    parser.add_argument('--folds', metavar='STORE_DIR',
+                        help='write one fold store from several fold pickles')
+    parser.add_argument('--compress', action='store_true',
+                        help='compress the images (zlib)')
+    parser.add_argument('--append', metavar='STORE_DIR',
+                        help='add the splits of the pickles to an existing store')
+    parser.add_argument('pickles', nargs='+')
+    args = parser.parse_args()
+    x_dtype = 'uint8' if args.uint8 else 'float32'
+    codec = 'zlib' if args.compress else None
+    if args.folds:
+        store_dir = write_fold_store(args.folds, args.pickles, x_dtype=x_dtype,
+                                     codec=codec)
+    elif args.append:
+        for filename in args.pickles:
+            f = open(filename, 'rb')
+            version = append(args.append, cPickle.load(f),
+                             x_dtype='uint8' if args.uint8 else None, codec=codec)
+            f.close()
+            print '%s added as version %d' % (filename, version)
+        store_dir = args.append
+    else:
+        store_dir = convert_pickle(args.pickles[0], *args.pickles[1:2],
+                                   x_dtype=x_dtype, codec=codec)
+    print 'Dataset written to %s' % store_dir
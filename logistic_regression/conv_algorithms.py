@@ -0,0 +1,158 @@
+'''
+conv_algorithms.py: The convolution algorithms of ConvLayer and ConvPoolLayer,
+and the per-machine choice of the fastest one for each layer shape.
+
+    'legacy'  theano.tensor.nnet.conv.conv2d (ConvOp), the original graph.
+    'corrmm'  CorrMM: every image is unrolled into a matrix of its windows
+              of the filter size (im2col) and multiplied by the filters with
+              the BLAS GEMM, in the forward pass and in both gradients.
+    'fft'     the cuFFT convolution of theano.sandbox.cuda.fftconv, only
+              available when Theano runs on the GPU (Theano 0.8 has no FFT
+              convolution for the CPU).
+
+All three compute the same convolution (the filters are flipped), up to the
+order in which the floats are summed. With algorithm='auto' (the default of
+the layers) the algorithm comes from a cache kept in Theano's compiledir,
+which is per machine; a shape and mini-batch size (with the device and floatX
+of Theano) not in the cache is benchmarked once, forward pass and gradients,
+with every available algorithm and the fastest one is stored, so later graph
+builds only read the cache. A cached algorithm that is not available anymore
+(the BLAS libraries or the device changed) is tuned again.
+
+command line: python conv_algorithms.py (prints the cache)
+'''
+
+#### Libraries
+# Standard library
+import json
+import os
+import time
+
+# Third-party libraries
+import numpy as np
+import theano
+import theano.tensor as T
+from theano.tensor.nnet import conv
+from theano.tensor.nnet.corr import CorrMM
+
+
+CACHE_FILE = os.path.join(theano.config.compiledir, 'conv_algorithms.json')
+
+
+def legacy_conv(inpt, filters, filter_shape, image_shape):
+    return conv.conv2d(input=inpt, filters=filters, filter_shape=filter_shape,
+                       image_shape=image_shape)
+
+def corrmm_conv(inpt, filters, filter_shape, image_shape):
+    # CorrMM is a correlation: flipping the filters makes it conv2d
+    return CorrMM()(inpt, filters[:, :, ::-1, ::-1])
+
+def fft_conv(inpt, filters, filter_shape, image_shape):
+    from theano.sandbox.cuda import fftconv
+    # the symbolic shape of the input: conv2d_fft multiplies its batch size
+    # by the input maps, which a None batch size of `image_shape` cannot do
+    return fftconv.conv2d_fft(inpt, filters, image_shape=None,
+                              filter_shape=filter_shape)
+
+ALGORITHMS = {'legacy': legacy_conv, 'corrmm': corrmm_conv, 'fft': fft_conv}
+
+
+def available():
+    "Return the names of the algorithms that can run on this machine."
+    names = ['legacy']
+    if theano.config.blas.ldflags:
+        names.append('corrmm')
+    if theano.config.device.startswith('gpu'):
+        names.append('fft')
+    return names
+
+def conv2d(inpt, filters, filter_shape, image_shape, algorithm='auto',
+           mini_batch_size=None):
+    """Return the convolution of `inpt` by `filters` with `algorithm` (one
+    of ALGORITHMS, or 'auto' for the cached choice of the shapes, see
+    `autotune`). `image_shape` is that of the layers, its mini-batch size
+    being only a hint; `mini_batch_size` is the one autotuned for
+    (`image_shape[0]` by default)."""
+    if algorithm == 'auto':
+        algorithm = autotune(filter_shape, image_shape,
+                             mini_batch_size or image_shape[0])
+    if algorithm not in ALGORITHMS:
+        raise ValueError('Unknown convolution algorithm %r, expected one of %s'
+                         % (algorithm, sorted(ALGORITHMS) + ['auto']))
+    return ALGORITHMS[algorithm](inpt, filters, filter_shape,
+                                 (None,) + tuple(image_shape[1:]))
+
+def cache_key(filter_shape, image_shape, mini_batch_size):
+    return '%s %s %d %s %s' % ('x'.join(map(str, filter_shape)),
+                               'x'.join(map(str, image_shape[1:])), mini_batch_size,
+                               theano.config.device, theano.config.floatX)
+
+def load_cache(cache_file=CACHE_FILE):
+    if not os.path.exists(cache_file):
+        return {}
+    f = open(cache_file)
+    cache = json.load(f)
+    f.close()
+    return cache
+
+def save_cache(cache, cache_file=CACHE_FILE):
+    # Other processes may have tuned other shapes meanwhile
+    merged = load_cache(cache_file)
+    merged.update(cache)
+    directory = os.path.dirname(os.path.abspath(cache_file))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = '%s.%d.tmp' % (cache_file, os.getpid())
+    f = open(tmp, 'w')
+    json.dump(merged, f, indent=1, sort_keys=True)
+    f.close()
+    os.rename(tmp, cache_file)
+
+def benchmark(algorithm, filter_shape, image_shape, mini_batch_size, repeats=3):
+    """Return the best of `repeats` timings, in seconds, of a training step
+    of the convolution on random data: the forward pass and the gradients
+    with respect to the filters and the input."""
+    rng = np.random.RandomState(0)
+    shape = (mini_batch_size,) + tuple(image_shape[1:])
+    x = theano.shared(rng.uniform(size=shape).astype(theano.config.floatX))
+    w = theano.shared(rng.normal(size=filter_shape).astype(theano.config.floatX))
+    out = conv2d(x, w, filter_shape, image_shape, algorithm)
+    f = theano.function([], [out] + T.grad(T.sum(out * out), [w, x]))
+    f()
+    times = []
+    for k in xrange(repeats):
+        start = time.time()
+        f()
+        times.append(time.time() - start)
+    return min(times)
+
+def autotune(filter_shape, image_shape, mini_batch_size, candidates=None,
+             cache_file=CACHE_FILE, force=False):
+    """Return the fastest algorithm for the shapes, from the cache or, when
+    they are not in it, the cached one is not available, or `force`, by
+    benchmarking `candidates` (the available algorithms by default) and
+    storing the result. Algorithms that fail to compile or run are skipped,
+    printing their error."""
+    key = cache_key(filter_shape, image_shape, mini_batch_size)
+    cache = load_cache(cache_file)
+    if key in cache and cache[key]['algorithm'] in available() and not force:
+        return cache[key]['algorithm']
+    timings = {}
+    for algorithm in candidates or available():
+        try:
+            timings[algorithm] = benchmark(algorithm, filter_shape, image_shape,
+                                           mini_batch_size)
+        except Exception, e:
+            print 'conv_algorithms: %s skipped for %s: %s' % (algorithm, key, e)
+            continue
+    if not timings:
+        raise RuntimeError('No convolution algorithm runs for ' + key)
+    best = min(timings, key=timings.get)
+    save_cache({key: {'algorithm': best, 'seconds': timings}}, cache_file)
+    return best
+
+
+if __name__ == '__main__':
+    for key, choice in sorted(load_cache().items()):
+        print '%-45s %-7s %s' % (key, choice['algorithm'], ' '.join(
+            '%s=%.4fs' % t for t in sorted(choice['seconds'].items())))
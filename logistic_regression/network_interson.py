@@ -24,9 +24,14 @@ In addition, the code within the SGD class includes Early Stopping, which can be
 
 #### Libraries
 # Standard library
+import copy
 import cPickle
 import gzip
+import json
 import math
+import os
+import resource
+import time
 
 # Third-party libraries
 import numpy as np
@@ -37,6 +42,9 @@ from theano.tensor.nnet import softmax
 from theano.tensor import shared_randomstreams
 from theano.tensor.signal import downsample
 from learning_functions import sgd, apply_nesterov_momentum, nesterov_momentum, get_or_compute_grads
+import dataset_store
+from streaming import ChunkStream
+from parallel import AsyncEvaluator, DataParallelStep
 
 # Activation functions for neurons
 def linear(z): return z
@@ -82,20 +90,53 @@ def errors(self, y):
             raise NotImplementedError()
 
 #### Load the Neumonia data
-def load_data_shared(filename="../data/neumonia_dataset_interson_elDeform_0_2.pkl"):
-    f = file(filename, 'rb')
-    training_data, validation_data, test_data = cPickle.load(f)
-    f.close()
+def load_data_shared(filename="../data/neumonia_dataset_interson_elDeform_0_2.pkl", mmap=True,
+                     stream=False, chunk_size=5000, deformer=None, version=None):
+    """Load the `(training, validation, test)` data into shared variables.
+    `filename` is either one of the pickled datasets or a directory written by
+    dataset_store.py. With `mmap` the shared variables are built straight
+    from the memory-mapped arrays, so the images are never unpickled or
+    copied when they are already stored as floatX. A pickle is converted the
+    first time into a store in its cache (dataset_store.cached_store), which
+    later runs map as long as the pickle's contents do not change; with
+    `mmap=False` it is unpickled every time instead.
+    With `stream` the training split is returned as a streaming.ChunkStream
+    that stays on disk and is paged in `chunk_size` examples at a time by
+    Network.SGD, instead of a shared variable holding the whole split.
+    A `deformer` (augmentation.ElasticDeformer) implies `stream` and deforms
+    every training chunk again as it is paged in.
+    A store is read as the snapshot that is current when it is opened (or as
+    its `version`), even if frames are appended to it during training.
+
+    """
+    stream = stream or deformer is not None
+    if mmap or stream or dataset_store.is_store(filename):
+        if not dataset_store.is_store(filename):
+            filename = dataset_store.cached_store(filename,
+                                                  x_dtype=theano.config.floatX)
+        training_data, validation_data, test_data = dataset_store.open_store(
+            filename, version=version)
+    else:
+        f = file(filename, 'rb')
+        training_data, validation_data, test_data = cPickle.load(f)
+        f.close()
     def shared(data):
         """Place the data into shared variables.  This allows Theano to copy
-        the data to the GPU, if one is available.
+        the data to the GPU, if one is available. uint8 images are kept as
+        uint8 and cast to floatX inside the compiled functions.
 
         """
+        x_dtype = theano.config.floatX
+        if getattr(data[0], 'dtype', None) == np.uint8:
+            x_dtype = 'uint8'
         shared_x = theano.shared(
-            np.asarray(data[0], dtype=theano.config.floatX), borrow=True)
+            np.asarray(data[0], dtype=x_dtype), borrow=True)
         shared_y = theano.shared(
             np.asarray(data[1], dtype=theano.config.floatX), borrow=True)
         return shared_x, T.cast(shared_y, "int32")
+    if stream:
+        return [ChunkStream(training_data[0], training_data[1], chunk_size, deformer),
+                shared(validation_data), shared(test_data)]
     return [shared(training_data), shared(validation_data), shared(test_data)]
 
 
@@ -104,30 +145,155 @@ def load_data_shared(filename="../data/neumonia_dataset_interson_elDeform_0_2.pk
 #### Main class used to construct and train networks
 class Network():
     
-    def __init__(self, layers, mini_batch_size):
+    def __init__(self, layers, mini_batch_size, input_dtype=None, input_scale=1.0,
+                 input_mask=None):
         """Takes a list of `layers`, describing the network architecture, and
         a value for the `mini_batch_size` to be used during training
         by stochastic gradient descent.
+        `input_dtype` is the dtype of the images fed to the network (floatX by
+        default, 'uint8' for 8-bit datasets). Other dtypes are cast to floatX
+        and multiplied by `input_scale` as the first step of the graph.
+        `input_mask` is an optional sector_mask.SectorMask applied to the
+        frames before anything else; the first layer then takes its `n_in`
+        inputs (or its `crop_shape` images).
+        The learning rate and the L2 regularization are the shared scalars
+        `eta_shared` and `lmbda_shared`, so the functions compiled by SGD are
+        kept and reused by later calls with other values (see reset_params).
 
         """
         self.layers = layers
         self.mini_batch_size = mini_batch_size
         self.params = [param for layer in self.layers for param in layer.params]
-        self.x = T.matrix("x")  
+        self.x = T.matrix("x", dtype=input_dtype or theano.config.floatX)
         self.y = T.ivector("y")
+        self.input_mask = input_mask
+        inpt = self.x
+        if input_mask is not None:
+            inpt = input_mask.apply(inpt)
+        if inpt.dtype != theano.config.floatX:
+            inpt = T.cast(inpt, theano.config.floatX)
+        if input_scale != 1.0:
+            inpt = inpt * np.asarray(input_scale, dtype=theano.config.floatX)
         init_layer = self.layers[0]
-        init_layer.set_inpt(self.x, self.x, self.mini_batch_size)
+        init_layer.set_inpt(inpt, inpt, self.mini_batch_size)
         for j in xrange(1, len(self.layers)):
             prev_layer, layer  = self.layers[j-1], self.layers[j]
             layer.set_inpt(
                 prev_layer.output, prev_layer.output_dropout, self.mini_batch_size)
         self.output = self.layers[-1].output
         self.output_dropout = self.layers[-1].output_dropout
+        self.eta_shared = theano.shared(np.asarray(0.0, dtype=theano.config.floatX), name='eta')
+        self.lmbda_shared = theano.shared(np.asarray(0.0, dtype=theano.config.floatX), name='lmbda')
+        # the initial weights and dropout random states, restored by
+        # reset_params: a host copy as large as the weights (see the README)
+        self._initial_state = [(v, v.get_value())
+                               for v in self.params + self.random_states()]
+        self._compiled = {}
+
+    def __getstate__(self):
+        "The compiled functions and the initial state are not pickled."
+        state = self.__dict__.copy()
+        state.pop('_compiled', None)
+        state.pop('_initial_state', None)
+        return state
+
+    def random_states(self):
+        "The shared random states of the dropout masks."
+        return [v for v in theano.gof.graph.inputs([self.output_dropout])
+                if getattr(v, 'default_update', None) is not None]
+
+    def reset_params(self):
+        """Restore the weights and the dropout random streams the network was
+        built with, so that the next call to SGD trains it from scratch
+        without recompiling anything, as in a hyperparameter sweep:
+
+            net = Network([...], mini_batch_size)
+            for eta in possible_learning_rate:
+                net.reset_params()
+                net.SGD(training_data, epochs, mini_batch_size, eta, ...)
+
+        """
+        for variable, value in self._initial_state:
+            variable.set_value(copy.deepcopy(value))
 
     def SGD(self, training_data, epochs, mini_batch_size, eta, 
-            validation_data, test_data, lmbda=0.0,tolerance = 5):
-        """Train the network using mini-batch stochastic gradient descent."""
-        training_x, training_y = training_data
+            validation_data, test_data, lmbda=0.0,tolerance = 5,
+            eval_batch_size=None, shuffle=False, shuffle_seed=0,
+            checkpoint=None, checkpoint_every=1, restore_best=True,
+            best_file=None, log_file=None, workers=1, async_validation=False):
+        """Train the network using mini-batch stochastic gradient descent.
+        `training_data` is either a pair of shared variables or a
+        streaming.ChunkStream, in which case the minibatches are read from the
+        chunk currently paged into its shared buffer.
+        Every example is used: the last minibatch of a split holds the
+        remainder. The validation and test splits are evaluated in batches of
+        `eval_batch_size` (`mini_batch_size` by default), which can be as
+        large as the memory allows since the layers take any batch size.
+        The functions are compiled on the first call only; later calls on the
+        same data and batch sizes just set `eta` and `lmbda`. Every call
+        starts with zero momentum.
+        With `shuffle` the training examples are visited in a new order every
+        epoch (drawn from `shuffle_seed`) without moving them: the compiled
+        training step gathers its minibatch through a shared int32
+        permutation, which is the only thing updated between epochs. A
+        ChunkStream also pages its chunks in a new order.
+        With `checkpoint` (a file name) the whole training state is saved to
+        that file every `checkpoint_every` epochs: the weights, the momentum
+        velocities, the random states, the counters, the early stopping
+        state and the metric lists. If the file exists when SGD is called,
+        training continues from it exactly where it stopped (see resume).
+        The file is removed when training finishes. (The elastic deformations
+        of a resumed ChunkStream are new ones, not the ones it would have
+        drawn.)
+        The weights of the epoch with the best validation sensitivity are
+        copied into host buffers every time it improves, and with
+        `restore_best` they are put back in the network when training ends
+        (otherwise they are kept in `best_params`). With `best_file` they are
+        also written to that file (see load_params).
+        The time of every epoch is split into the training steps, the
+        evaluations and the rest (Python and data loading between steps),
+        and recorded with the training throughput and the peak resident
+        memory in `timings`, one dict per epoch; `compile_time` is the time
+        spent compiling in this call. With `log_file` each record (with the
+        validation metrics) is also appended to that file as a line of JSON.
+        With `workers` > 1 every minibatch is split between that many
+        processes (Theano on the CPU only), whose gradients are averaged
+        before the update (see parallel.py); the training data must be in
+        shared variables.
+        With `async_validation` the weights of every epoch are evaluated by a
+        worker process (parallel.AsyncEvaluator, Theano on the CPU only)
+        while the next epoch trains, so the metrics and the early stopping of
+        an epoch are handled one epoch late, and each timing record holds the
+        training time of the epoch that follows the one it evaluates.
+
+        """
+        streamed = isinstance(training_data, ChunkStream)
+        if streamed and workers > 1:
+            raise ValueError('workers > 1 needs the training data in shared variables, '
+                             'not a ChunkStream')
+        rng = np.random.RandomState(shuffle_seed) if shuffle else None
+        arguments = dict(epochs=epochs, mini_batch_size=mini_batch_size,
+                         eta=eta, lmbda=lmbda, tolerance=tolerance,
+                         eval_batch_size=eval_batch_size, shuffle=shuffle,
+                         shuffle_seed=shuffle_seed, async_validation=async_validation)
+        # how the run is saved and parallelized, not what it trains: saved for
+        # resume, but not checked against the checkpoint
+        options = dict(checkpoint_every=checkpoint_every, restore_best=restore_best,
+                       best_file=best_file, log_file=log_file, workers=workers)
+        state = None
+        if checkpoint is not None and os.path.exists(checkpoint):
+            state = load_checkpoint(checkpoint)
+            if state['arguments'] != arguments:
+                raise ValueError('%s was written by SGD with %r, not %r' % (
+                    checkpoint, state['arguments'], arguments))
+            if rng is not None:
+                # restored before the stream draws its first chunk order
+                rng.set_state(state['shuffle_state'])
+        if streamed:
+            training_x, training_y = training_data.start(
+                mini_batch_size, rng, state and state['chunk_order'])
+        else:
+            training_x, training_y = training_data
         validation_x, validation_y = validation_data
         test_x, test_y = test_data
 	
@@ -137,110 +303,46 @@ class Network():
 	#self.tolerance = tolerance
 	
         # compute number of minibatches for training, validation and testing
-        num_training_batches = size(training_data)/mini_batch_size
-        num_validation_batches = size(validation_data)/mini_batch_size
-        num_test_batches = size(test_data)/mini_batch_size
-
-        # define the (regularized) cost function, symbolic gradients, and updates
-        l2_norm_squared = sum([(layer.w**2).sum() for layer in self.layers])
-	#l1_norm = sum([(abs(layer.w)).sum() for layer in self.layers])
-        cost2= self.layers[-1].cost(self)+0.5*lmbda*l2_norm_squared/num_training_batches 
-	#New version with L1 regularization
-	#cost1 = self.layers[-1].cost(self)+lmbda*l1_norm/num_training_batches
-        #grads = T.grad(cost, self.params)
-        updates = nesterov_momentum(cost2, self.params,eta)	###cost2 <-> cost1
-	strikes = 0
-
-        # define functions to train a mini-batch, and to compute the
-        # accuracy in validation and test mini-batches.
-        i = T.lscalar() # mini-batch index
-        train_mb = theano.function(
-            [i], cost2, updates=updates,	###cost2 <-> cost1
-            givens={
-                self.x:
-                training_x[i*self.mini_batch_size: (i+1)*self.mini_batch_size],
-                self.y: 
-                training_y[i*self.mini_batch_size: (i+1)*self.mini_batch_size]
-            })
-        validate_mb_accuracy = theano.function(
-            [i], self.layers[-1].accuracy(self.y),
-            givens={
-                self.x: 
-                validation_x[i*self.mini_batch_size: (i+1)*self.mini_batch_size],
-                self.y: 
-                validation_y[i*self.mini_batch_size: (i+1)*self.mini_batch_size]
-            })
-        test_mb_accuracy = theano.function(
-            [i], self.layers[-1].accuracy(self.y),
-            givens={
-                self.x: 
-                test_x[i*self.mini_batch_size: (i+1)*self.mini_batch_size],
-                self.y: 
-                test_y[i*self.mini_batch_size: (i+1)*self.mini_batch_size]
-            })
-	validation_predictions = theano.function([i], self.layers[-1].y_out,givens={self.x: 
-                validation_x[i*self.mini_batch_size: (i+1)*self.mini_batch_size]})
-	true_output = validation_y[i*self.mini_batch_size: (i+1)*self.mini_batch_size]
-        self.test_mb_predictions = theano.function(
-            [i], self.layers[-1].y_out,
-            givens={
-                self.x: 
-                test_x[i*self.mini_batch_size: (i+1)*self.mini_batch_size]
-            })
-	#Starting with specificity and sensitivity analysis
-	tru_posi = theano.function([i], self.layers[-1].tru_pos(self.y), givens={
-                self.x: 
-                validation_x[i*self.mini_batch_size: (i+1)*self.mini_batch_size],
-                self.y: 
-                validation_y[i*self.mini_batch_size: (i+1)*self.mini_batch_size]
-            })
-	tru_nega = theano.function([i], self.layers[-1].tru_neg(self.y), givens={
-                self.x: 
-                validation_x[i*self.mini_batch_size: (i+1)*self.mini_batch_size],
-                self.y: 
-                validation_y[i*self.mini_batch_size: (i+1)*self.mini_batch_size]
-            })
-	false_posi = theano.function([i], self.layers[-1].false_pos(self.y), givens={
-                self.x: 
-                validation_x[i*self.mini_batch_size: (i+1)*self.mini_batch_size],
-                self.y: 
-                validation_y[i*self.mini_batch_size: (i+1)*self.mini_batch_size]
-            })
-	false_nega = theano.function([i], self.layers[-1].false_neg(self.y), givens={
-                self.x: 
-                validation_x[i*self.mini_batch_size: (i+1)*self.mini_batch_size],
-                self.y: 
-                validation_y[i*self.mini_batch_size: (i+1)*self.mini_batch_size]
-            })
-	#For testing calculations
-	tru_posi_t = theano.function([i], self.layers[-1].tru_pos(self.y), givens={
-                self.x: 
-                test_x[i*self.mini_batch_size: (i+1)*self.mini_batch_size],
-                self.y: 
-                test_y[i*self.mini_batch_size: (i+1)*self.mini_batch_size]
-            })
-	tru_nega_t = theano.function([i], self.layers[-1].tru_neg(self.y), givens={
-                self.x: 
-                test_x[i*self.mini_batch_size: (i+1)*self.mini_batch_size],
-                self.y: 
-                test_y[i*self.mini_batch_size: (i+1)*self.mini_batch_size]
-            })
-	false_posi_t = theano.function([i], self.layers[-1].false_pos(self.y), givens={
-                self.x: 
-                test_x[i*self.mini_batch_size: (i+1)*self.mini_batch_size],
-                self.y: 
-                test_y[i*self.mini_batch_size: (i+1)*self.mini_batch_size]
-            })
-	false_nega_t = theano.function([i], self.layers[-1].false_neg(self.y), givens={
-                self.x: 
-                test_x[i*self.mini_batch_size: (i+1)*self.mini_batch_size],
-                self.y: 
-                test_y[i*self.mini_batch_size: (i+1)*self.mini_batch_size]
-            })
+        num_training_batches = int(math.ceil(float(size(training_data))/mini_batch_size))
+
+        self.eta_shared.set_value(np.asarray(eta, dtype=theano.config.floatX))
+        self.lmbda_shared.set_value(np.asarray(lmbda, dtype=theano.config.floatX))
+        key = (training_x, training_y, validation_x, validation_y, test_x, test_y,
+               num_training_batches, eval_batch_size, bool(shuffle), workers)
+        compile_start = time.time()
+        if key not in self.__dict__.setdefault('_compiled', {}):
+            order = None
+            if streamed and shuffle:
+                order = training_data.shared_order
+            elif shuffle:
+                order = theano.shared(
+                    np.arange(size(training_data), dtype='int32'), name='order')
+            self._compiled[key] = (order,) + self.compile_sgd(
+                (training_x, training_y), validation_data, test_data,
+                num_training_batches, eval_batch_size, order, workers)
+        (order, train_mb, validate, test, self.test_mb_predictions,
+         velocities) = self._compiled[key]
+        self.compile_time = time.time() - compile_start
+        for velocity in velocities:
+            velocity.set_value(np.zeros_like(velocity.get_value(borrow=True)))
+        if state is not None:
+            # before the workers are started, so they get the restored weights
+            for variable, value in zip(self.params + velocities + self.random_states(),
+                                       state['params'] + state['velocities'] + state['random_states']):
+                variable.set_value(value)
+        if workers > 1:
+            train_mb.start(self.random_states())
+        if streamed:
+            # minibatch indices are global; the compiled function only sees
+            # the chunk that is paged in
+            train_chunk_mb = train_mb
+            def train_mb(minibatch_index):
+                return train_chunk_mb(training_data.local_index(minibatch_index))
 	#metrics for net performance
 	self.valores_test = []
 	self.valores_val = []
 	self.cost_train = []
+	self.cost_validation = []
 	self.valores_train = []
 	self.TP = []
 	self.TN = []
@@ -255,23 +357,120 @@ class Network():
 	self.mcc = []
 	self.test_sensitivity = []
 	self.test_specificity = []
+        self.timings = []
 
         # Do the actual training
         best_sensitivity = 0.0
 	best_iteration = None
 	strikes = 0 
 	best_F1 = 0.0
-        for epoch in xrange(epochs):
-            for minibatch_index in xrange(num_training_batches):
-                iteration = num_training_batches*epoch+minibatch_index
+        start_epoch = 0
+        best_params = None
+        if state is not None:
+            for name in HISTORIES:
+                setattr(self, name, state['history'][name])
+            (start_epoch, iteration, best_sensitivity, best_iteration, strikes,
+             best_F1) = state['counters']
+            if state['F1'] is not None:
+                F1 = state['F1']
+            best_params = state['best_params']
+            print("Resuming from {0} at epoch {1}".format(checkpoint, start_epoch))
+        compile_time = self.compile_time
+        evaluator = None
+        if async_validation:
+            evaluator = AsyncEvaluator(self.params, validate,
+                                       test if test_data else None, evaluate)
+            evaluator.start()
+            if state is not None and state['pending']:
+                # the weights of the checkpoint were not evaluated yet
+                evaluator.submit(best_sensitivity, start_epoch - 1,
+                                 num_training_batches*start_epoch - 1)
+
+        def record_timing(epoch, trained, epoch_start, train_time, eval_time, metrics):
+            """Append the timing record of a step to `timings` (and to
+            `log_file`, with the validation `metrics`) and print it. A step that
+            did not train (the last one with async_validation) has no
+            images_per_second."""
+            epoch_time = time.time() - epoch_start
+            timing = {
+                'epoch': epoch, 'iteration': iteration, 'eta': eta, 'lmbda': lmbda,
+                'mini_batch_size': mini_batch_size,
+                'epoch_time': epoch_time, 'train_time': train_time,
+                'eval_time': eval_time,
+                'overhead_time': epoch_time - train_time - eval_time,
+                'compile_time': compile_time,
+                'images_per_second': (size(training_data) / max(train_time, 1e-9)
+                                      if trained else None),
+                'peak_memory_mb': peak_memory_mb()}
+            self.timings.append(timing)
+            print("Epoch {0}: {1:.1f}s ({2:.1f}s training, {3:.1f}s evaluation), "
+                  "{4} images/s, {5:.0f} MB".format(
+                      epoch, epoch_time, train_time, eval_time,
+                      '-' if not trained else '%.0f' % timing['images_per_second'],
+                      timing['peak_memory_mb']))
+            if log_file is not None:
+                f = open(log_file, 'a')
+                f.write(json.dumps(dict(timing, **metrics), sort_keys=True) + '\n')
+                f.close()
+
+        def end_epoch(step, F1):
+            """Checkpoint the training state after step `step` and, with
+            async_validation, start evaluating the weights it trained."""
+            if (checkpoint is not None and step < epochs and
+                    (step + 1) % checkpoint_every == 0):
+                save_checkpoint(checkpoint, {
+                    'arguments': arguments,
+                    'options': options,
+                    'params': [p.get_value() for p in self.params],
+                    'velocities': [v.get_value() for v in velocities],
+                    'random_states': [v.get_value() for v in self.random_states()],
+                    'shuffle_state': rng.get_state() if rng is not None else None,
+                    'chunk_order': training_data.next_order if streamed else None,
+                    'history': dict((name, getattr(self, name)) for name in HISTORIES),
+                    'counters': (step + 1, iteration, best_sensitivity,
+                                 best_iteration, strikes, best_F1),
+                    'F1': F1,
+                    'best_params': best_params,
+                    'pending': evaluator is not None})
+            if evaluator is not None and step < epochs:
+                evaluator.submit(best_sensitivity, step,
+                                 num_training_batches*(step + 1) - 1)
+
+        # with async_validation, step `step` trains epoch `step` and
+        # handles the metrics of epoch `step` - 1
+        for step in xrange(start_epoch, epochs + (evaluator is not None)):
+            epoch_start = time.time()
+            train_time = 0.0
+            if shuffle and not streamed and step < epochs:
+                # in place, as the workers of a DataParallelStep share it
+                order.get_value(borrow=True)[:] = rng.permutation(size(training_data))
+            for minibatch_index in xrange(num_training_batches if step < epochs else 0):
+                iteration = num_training_batches*step+minibatch_index
                 if iteration % 1000 == 0: 
                     print("Training mini-batch number {0}".format(iteration))
+                step_start = time.time()
                 cost_ij = train_mb(minibatch_index) #training
+                train_time += time.time() - step_start
 		self.cost_train.append(cost_ij)
-	    TP = float(np.sum([np.size(tru_posi(j)) for j in xrange(num_validation_batches)]))
-	    TN = float(np.sum([np.size(tru_nega(j)) for j in xrange(num_validation_batches)]))
-	    FP = float(np.sum([np.size(false_posi(j)) for j in xrange(num_validation_batches)]))
-	    FN = float(np.sum([np.size(false_nega(j)) for j in xrange(num_validation_batches)]))
+            eval_start = time.time()
+            if evaluator is None:
+                epoch, evaluated = step, self.params
+                validation_results, test_results = evaluate(validate), None
+            elif evaluator.pending is None:
+                # nothing was trained before this step, so nothing to evaluate
+                record_timing(step, True, epoch_start, train_time, 0.0, dict(
+                    sensitivity=None, specificity=None, validation_cost=None,
+                    validation_accuracy=None))
+                compile_time = 0.0
+                end_epoch(step, locals().get('F1'))
+                continue
+            else:
+                epoch, iteration, validation_results, test_results = evaluator.result()
+                evaluated = evaluator.snapshot
+	    cost_validation, validation_accuracy, TP, TN, FP, FN = validation_results
+            eval_time = time.time() - eval_start
+	    self.cost_validation.append(cost_validation)
+	    self.valores_val.append(validation_accuracy)
 	    sensitivity = TP/(TP + FN)
 	    specificity = TN/(TN + FP)
 	    total_total = TP + TN + FN + FP
@@ -301,11 +500,14 @@ class Network():
                     print("This is the best validation Sensitivity to date.")
                     best_sensitivity = sensitivity
                     best_iteration = iteration
+                    best_params = copy_params(evaluated, best_params)
                     if test_data:
-			   TP_t = float(np.sum([np.size(tru_posi_t(j)) for j in xrange(num_test_batches)]))
-	    		   TN_t = float(np.sum([np.size(tru_nega_t(j)) for j in xrange(num_test_batches)]))
-	    		   FP_t = float(np.sum([np.size(false_posi_t(j)) for j in xrange(num_test_batches)]))
-	    		   FN_t = float(np.sum([np.size(false_nega_t(j)) for j in xrange(num_test_batches)]))
+			   eval_start = time.time()
+			   if test_results is None:
+			       test_results = evaluate(test)
+			   cost_t, test_accuracy, TP_t, TN_t, FP_t, FN_t = test_results
+			   eval_time += time.time() - eval_start
+			   self.valores_test.append(test_accuracy)
 			   test_sensitivity = TP_t/(TP_t + FN_t)
 	    		   test_specificity = TN_t/(TN_t + FP_t)
 		       	   self.test_sensitivity.append(test_sensitivity)
@@ -336,12 +538,34 @@ class Network():
             except UnboundLocalError:
 		print "F1 wasn't calculated"
 		strikes = strikes + 1
+
+            record_timing(epoch, step < epochs, epoch_start, train_time, eval_time, dict(
+                sensitivity=sensitivity, specificity=specificity,
+                validation_cost=cost_validation,
+                validation_accuracy=validation_accuracy))
+            compile_time = 0.0
 	
 	    if strikes == tolerance:
 		break
               
+            end_epoch(step, locals().get('F1'))
 	self.best_sensitivity = best_sensitivity
 	self.best_iteration = best_iteration	
+        self.best_params = best_params
+        if best_params is not None and restore_best:
+            for param, value in zip(self.params, best_params):
+                param.set_value(value)
+            self.best_params = None
+        if best_params is not None and best_file is not None:
+            save_checkpoint(best_file, best_params)
+        if streamed:
+            training_data.stop()
+        if workers > 1:
+            train_mb.stop()
+        if evaluator is not None:
+            evaluator.stop()
+        if checkpoint is not None and os.path.exists(checkpoint):
+            os.remove(checkpoint)
         print("Finished training network.")
         print("Best Sensitivity of {0:.4%} obtained at iteration {1}".format(
             best_sensitivity,iteration))
@@ -349,9 +573,181 @@ class Network():
 	#self.best_test = test_accuracy
         #print("Corresponding test accuracy of {0:.2%}".format(test_accuracy))
 
+    def load_params(self, filename):
+        """Set the weights of the network to the ones saved in `filename` by
+        SGD(..., best_file=filename)."""
+        for param, value in zip(self.params, load_checkpoint(filename)):
+            param.set_value(value)
+
+    def resume(self, checkpoint, training_data, validation_data, test_data,
+               **options):
+        """Continue the training saved in the file `checkpoint` by
+        SGD(..., checkpoint=checkpoint), with the same arguments, including
+        checkpoint_every, restore_best, best_file, log_file and workers
+        unless they are given in `options`. The network must have the same
+        architecture (for instance, rebuilt by the same script)."""
+        state = load_checkpoint(checkpoint)
+        arguments = dict(state['arguments'], **dict(state.get('options', {}), **options))
+        self.SGD(training_data, arguments.pop('epochs'),
+                 arguments.pop('mini_batch_size'), arguments.pop('eta'),
+                 validation_data, test_data, checkpoint=checkpoint, **arguments)
+
+    def compile_sgd(self, training_data, validation_data, test_data,
+                    num_training_batches, eval_batch_size=None, order=None,
+                    workers=1):
+        """Compile the functions used by SGD for the shared variables
+        `training_data`, `validation_data` and `test_data`: the training step
+        on a minibatch, the evaluations of the validation and test splits and
+        the test predictions. `eta_shared` and `lmbda_shared` are inputs of
+        the graph, not constants. Also returns the momentum velocities.
+        With `order`, a shared int32 vector, minibatch `i` holds the rows
+        `order[i*mini_batch_size: (i+1)*mini_batch_size]` of the training
+        data instead of the contiguous ones.
+        With `workers` > 1 the training step is a parallel.DataParallelStep.
+
+        """
+        training_x, training_y = training_data
+        validation_x, validation_y = validation_data
+        test_x, test_y = test_data
+
+        # define the (regularized) cost function, symbolic gradients, and updates
+        l2_norm_squared = sum([(w**2).sum() for layer in self.layers
+                               for w in (layer.weights if hasattr(layer, 'weights')
+                                         else [layer.w])])
+	#l1_norm = sum([(abs(layer.w)).sum() for layer in self.layers])
+        cost2= self.layers[-1].cost(self)+0.5*self.lmbda_shared*l2_norm_squared/num_training_batches 
+	#New version with L1 regularization
+	#cost1 = self.layers[-1].cost(self)+self.lmbda_shared*l1_norm/num_training_batches
+        #grads = T.grad(cost, self.params)
+
+        # define functions to train a mini-batch, and to compute the
+        # accuracy in validation and test mini-batches.
+        i = T.lscalar() # mini-batch index
+        batch = slice(i*self.mini_batch_size, (i+1)*self.mini_batch_size)
+        if workers > 1:
+            # the workers train on the rows start:stop of the minibatch
+            start, stop = T.lscalars('start', 'stop')
+            batch = slice(start, stop)
+        if order is not None:
+            # only the rows of the minibatch are gathered (and then cast)
+            batch = order[batch]
+        givens = {self.x: as_input(training_x[batch], self.x),
+                  self.y: training_y[batch]}
+        if workers > 1:
+            train_mb = DataParallelStep(
+                cost2, self.params, [start, stop], givens,
+                lambda grads: nesterov_momentum(grads, self.params, self.eta_shared),
+                workers, self.mini_batch_size, size(training_data), order)
+            velocities = train_mb.velocities
+        else:
+            updates = nesterov_momentum(cost2, self.params,self.eta_shared)	###cost2 <-> cost1
+            params = set(self.params)
+            velocities = [v for v in updates if v not in params]
+            train_mb = theano.function(
+                [i], cost2, updates=updates,	###cost2 <-> cost1
+                givens=givens)
+        # one call evaluates a whole split: the cost, the accuracy and the
+        # contingency table
+        validate = self.evaluation_function(
+            validation_x, validation_y, size(validation_data), eval_batch_size)
+        test = self.evaluation_function(
+            test_x, test_y, size(test_data), eval_batch_size)
+        test_mb_predictions = theano.function(
+            [i], self.layers[-1].y_out,
+            givens={
+                self.x: as_input(
+                    test_x[i*self.mini_batch_size: (i+1)*self.mini_batch_size], self.x)
+            })
+        return train_mb, validate, test, test_mb_predictions, velocities
+
+    def evaluation_function(self, data_x, data_y, num_examples, batch_size=None):
+        """Compile the evaluation of the `num_examples` examples of
+        `(data_x, data_y)` as a single call. A scan over batches of
+        `batch_size` examples (`mini_batch_size` by default; the last one
+        holds the remainder) runs one forward pass on each and accumulates in
+        the graph the cost (without dropout), the accuracy and the
+        [TP, TN, FP, FN] counts, so the split costs one Python-to-Theano call
+        instead of one per minibatch. The cost and accuracy returned are
+        means over the examples."""
+        batch_size = batch_size or self.mini_batch_size
+        outputs = [self.layers[-1].cost_validation(self),
+                   self.layers[-1].accuracy(self.y),
+                   self.layers[-1].confusion(self.y)]
+        def minibatch(j):
+            batch_y = data_y[j*batch_size: (j+1)*batch_size]
+            cost, accuracy, counts = theano.clone(outputs, replace={
+                self.x: as_input(data_x[j*batch_size: (j+1)*batch_size], self.x),
+                self.y: batch_y})
+            examples = T.cast(batch_y.shape[0], theano.config.floatX)
+            return cost*examples, accuracy*examples, counts
+        (costs, accuracies, counts), updates = theano.scan(
+            minibatch, sequences=T.arange(int(math.ceil(float(num_examples)/batch_size))))
+        return theano.function(
+            [], [costs.sum()/num_examples, accuracies.sum()/num_examples,
+                 counts.sum(axis=0)],
+            updates=updates)
+
+#### Checkpoints
+# the per-epoch lists of Network.SGD saved in a checkpoint
+HISTORIES = ['valores_test', 'valores_val', 'cost_train', 'cost_validation',
+             'valores_train', 'TP', 'TN', 'FN', 'FP', 'PPV', 'NPV', 'F1',
+             'sensitivity', 'specificity', 'total_mini_batch', 'mcc',
+             'test_sensitivity', 'test_specificity', 'timings']
+
+def save_checkpoint(filename, state):
+    """Pickle `state` into `filename` atomically: it is written to a
+    temporary file in the same directory, synced, and renamed over the
+    previous checkpoint, so a crash leaves either the old or the new one."""
+    tmp_name = filename + '.tmp'
+    f = open(tmp_name, 'wb')
+    cPickle.dump(state, f, protocol=cPickle.HIGHEST_PROTOCOL)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.rename(tmp_name, filename)
+
+def load_checkpoint(filename):
+    f = open(filename, 'rb')
+    state = cPickle.load(f)
+    f.close()
+    return state
+
+def copy_params(params, buffers=None):
+    """Copy the values of the shared variables `params` into `buffers` (a
+    list of arrays of the same shapes, allocated on the first call when
+    None) and return them."""
+    if buffers is None:
+        return [param.get_value() for param in params]
+    for param, buf in zip(params, buffers):
+        np.copyto(buf, param.get_value(borrow=True))
+    return buffers
+
 #### Miscellanea
+def peak_memory_mb():
+    "Peak resident memory of this process, in MB (ru_maxrss is in KB on Linux)."
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def evaluate(evaluation):
+    """Run the compiled `evaluation` of a split (see
+    Network.evaluation_function). Returns the mean cost and accuracy and the
+    total TP, TN, FP and FN counts, as floats."""
+    cost, accuracy, counts = evaluation()
+    TP, TN, FP, FN = counts.astype(float)
+    return float(cost), float(accuracy), TP, TN, FP, FN
+
+def as_input(data_x, x):
+    """Cast the images `data_x` to the dtype of the network input `x`. Give
+    it the minibatch slice, so only the minibatch is converted: a cast of a
+    whole split inside a scan is hoisted out of the loop, and would convert
+    the split on every call."""
+    if data_x.dtype != x.dtype:
+        return T.cast(data_x, x.dtype)
+    return data_x
+
 def size(data):
     "Return the size of the dataset `data`."
+    if isinstance(data, ChunkStream):
+        return data.num_examples
     return data[0].get_value(borrow=True).shape[0]
 
 def dropout_layer(layer, p_dropout):
@@ -0,0 +1,167 @@
+'''
+streaming.py: Out-of-core training data for Network.SGD.
+
+The training split stays on disk (usually a memory-mapped dataset_store) and
+is paged into a shared variable one chunk of many minibatches at a time. Two
+host buffers are used: while the compiled training function works through the
+chunk held by the shared variable, a background thread copies the next chunk
+into the other buffer, so the training step does not wait for the disk.
+With an augmentation.ElasticDeformer, the chunk is deformed by its worker
+processes on the way into the buffer, so every epoch sees new deformations.
+Compressed stores are decompressed by dataset_store's threads straight into
+the buffer. Shuffling (Network.SGD(..., shuffle=True)) pages the chunks in a
+new order every epoch and visits the rows of each chunk through a shared
+permutation, so nothing is copied besides the chunks themselves.
+'''
+
+#### Libraries
+# Standard library
+import threading
+
+# Third-party libraries
+import numpy as np
+import theano
+
+import dataset_store
+
+
+class ChunkStream(object):
+
+    def __init__(self, data_x, data_y, chunk_size=5000, deformer=None):
+        """`data_x` and `data_y` are array-likes indexed by example (for
+        instance the np.memmap arrays returned by dataset_store.open_store).
+        `chunk_size` is the number of examples held in memory at once; it is
+        rounded down to a multiple of the mini-batch size by `start`. The
+        last minibatch holds the remainder of the examples.
+        `deformer` is an optional augmentation.ElasticDeformer.
+
+        """
+        if len(data_x) != len(data_y):
+            raise ValueError('Got %d images for %d labels' %
+                             (len(data_x), len(data_y)))
+        self.data_x = data_x
+        self.data_y = data_y
+        self.num_examples = len(data_x)
+        self.chunk_size = chunk_size
+        self.deformer = deformer
+        self.shared_x = None
+        self.shared_y = None
+        self.shared_order = None
+        self._thread = None
+
+    def start(self, mini_batch_size, rng=None, order=None):
+        """Allocate the two buffers and the shared variables, and start
+        loading the first chunk. Returns `(shared_x, shared_y)`, which hold
+        the current chunk and are used in the `givens` of the training
+        function with chunk-local minibatch indices (see `local_index`).
+        With `rng` (a numpy RandomState) the chunks are paged in a new order
+        every epoch, the last (partial) chunk staying last, and
+        `shared_order` holds a new permutation of the rows of each chunk
+        paged in, through which the training function reads the minibatches.
+        `order` is the chunk order of the first epoch (drawn from `rng` by
+        default), as given by `next_order` when training is checkpointed.
+
+        """
+        self.stop()
+        self.rng = rng
+        self.mini_batch_size = mini_batch_size
+        self.batches_per_chunk = max(1, self.chunk_size // mini_batch_size)
+        self.num_batches = -(-self.num_examples // mini_batch_size)
+        self.num_chunks = -(-self.num_batches // self.batches_per_chunk)
+        rows = self.batches_per_chunk * mini_batch_size
+        frame_shape = tuple(self.data_x.shape[1:])
+        self._buffers = [
+            (np.empty((rows,) + frame_shape, dtype=self.data_x.dtype),
+             np.empty((rows,), dtype='int32')) for k in xrange(2)]
+        self._filled = [None, None]
+        if self.shared_x is None:
+            self.shared_x = theano.shared(self._buffers[0][0], borrow=True)
+            self.shared_y = theano.shared(self._buffers[0][1], borrow=True)
+        else:
+            self.shared_x.set_value(self._buffers[0][0], borrow=True)
+            self.shared_y.set_value(self._buffers[0][1], borrow=True)
+        if rng is not None and self.shared_order is None:
+            self.shared_order = theano.shared(np.arange(rows, dtype='int32'), name='order')
+        self._order = order if order is not None else self._chunk_order()
+        self._next_order = None
+        self._current = None
+        if self.deformer is not None:
+            # the workers are forked before the prefetch thread exists
+            self.deformer.start(self.data_x)
+        self._prefetch(self._order[0], 0)
+        return self.shared_x, self.shared_y
+
+    @property
+    def next_order(self):
+        """The chunk order of the next epoch, once the last chunk of the
+        current one is paged in."""
+        if self._next_order is not None:
+            return self._next_order
+        return self._order
+
+    def _chunk_order(self):
+        "The order in which the chunks of an epoch are paged in."
+        if self.rng is None:
+            return range(self.num_chunks)
+        return list(self.rng.permutation(self.num_chunks - 1)) + [self.num_chunks - 1]
+
+    def _fill(self, chunk, slot):
+        start = chunk * self.batches_per_chunk * self.mini_batch_size
+        stop = min(start + self.batches_per_chunk * self.mini_batch_size,
+                   self.num_examples)
+        buf_x, buf_y = self._buffers[slot]
+        if self.deformer is not None:
+            self.deformer.deform(slice(start, stop), buf_x[:stop - start])
+        else:
+            dataset_store.read_rows(self.data_x, start, stop, buf_x[:stop - start])
+        buf_y[:stop - start] = self.data_y[start:stop]
+        self._filled[slot] = (chunk, stop - start)
+
+    def _prefetch(self, chunk, slot):
+        self._thread = threading.Thread(target=self._fill, args=(chunk, slot))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _swap(self, position):
+        """Wait for the chunk at `position` in the epoch's order, hand it to
+        the shared variables and prefetch the next."""
+        if position == 0 and self._next_order is not None:
+            self._order, self._next_order = self._next_order, None
+        chunk = self._order[position]
+        slot = 0 if self._current is None else 1 - self._current
+        self._thread.join()
+        filled_chunk, rows = self._filled[slot]
+        if filled_chunk != chunk:
+            # Only happens when training does not walk the chunks in order.
+            self._fill(chunk, slot)
+            filled_chunk, rows = self._filled[slot]
+        buf_x, buf_y = self._buffers[slot]
+        self.shared_x.set_value(buf_x[:rows], borrow=True)
+        self.shared_y.set_value(buf_y[:rows], borrow=True)
+        if self.rng is not None:
+            self.shared_order.set_value(self.rng.permutation(rows).astype('int32'))
+        self._current = slot
+        # The next chunk goes into the buffer that is not in use; after the
+        # last chunk it is the first chunk of the next epoch.
+        if position + 1 < self.num_chunks:
+            self._prefetch(self._order[position + 1], 1 - slot)
+        else:
+            self._next_order = self._chunk_order()
+            self._prefetch(self._next_order[0], 1 - slot)
+
+    def local_index(self, minibatch_index):
+        """Return the index of `minibatch_index` inside the chunk held by the
+        shared variables, paging in its chunk first when it is a new one."""
+        position, local = divmod(minibatch_index, self.batches_per_chunk)
+        if self._current is None or local == 0 or position != self._position:
+            self._swap(position)
+            self._position = position
+        return local
+
+    def stop(self):
+        "Wait for the background thread and stop the deformation workers."
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.deformer is not None:
+            self.deformer.close()
@@ -7,6 +7,8 @@ from datetime import datetime
 # Look for the data at:
 #neumonia_dataset_interson_elDeform_SinNeumEvid_3.pkl
 file_name = "../data/neumonia_dataset_interson_elDeform_SinNeumEvid_4.pkl"
+# Sector mask of the probe (python sector_mask.py), or None to use the whole frames
+mask_file = None
 ########################################
 # HyperParameters
 startTime = datetime.now()
@@ -16,28 +18,46 @@ possible_lambda = [5.0,2.0,3.0,1.0,1.0/10.0,1.0/100.0,1.0/1000.0] #7
 #possible_lambda = [1.0/1000.0] #7
 possible_mini_batch = [100]
 possible_dropout =0.5
+# Processes sharing each minibatch (parallel.py); set OMP_NUM_THREADS=1 when it is above 1
+workers = 1
 ########################################
 # Import libraries
 import cPickle
+import os
 import network_interson
 from network_interson import Network
 from layer_types import SigmoidLayer, SoftmaxLayer
+from sector_mask import SectorMask
 training_data, validation_data, test_data = network_interson.load_data_shared(filename= file_name)
 from network_interson import ReLU
 from theano.tensor import tanh
 
+# Only the pixels inside the scan sector are fed to the classifier
+sector = None
+n_inputs = 256*256
+if mask_file:
+	sector = SectorMask.load(mask_file, mode='pixels')
+	n_inputs = sector.n_in
 ########################################
 #Actual training and research of Hyperparameters
 
-for i in range(len(possible_learning_rate)):
-	for j in range(len(possible_lambda)):
-		for z in range(len(possible_mini_batch)):
-			mini_batch_size = possible_mini_batch[z]
-			dropout = possible_dropout
-			net = Network([
-				SoftmaxLayer(n_in=256*256, n_out=2)], mini_batch_size)
-			net.SGD(training_data, 50, mini_batch_size, possible_learning_rate[i],validation_data, test_data,lmbda = possible_lambda[j])
+# One network (and one set of compiled functions) per mini-batch size; its
+# weights are reset before each learning rate/lambda pair
+for z in range(len(possible_mini_batch)):
+	mini_batch_size = possible_mini_batch[z]
+	dropout = possible_dropout
+	net = Network([
+		SoftmaxLayer(n_in=n_inputs, n_out=2)], mini_batch_size, input_mask=sector)
+	for i in range(len(possible_learning_rate)):
+		for j in range(len(possible_lambda)):
 			name = 'net_SinEvid4_logistic_%(learning)g_%(lambda)g_%(mini_batch)g_%(dropout)g.pkl' %{"learning": possible_learning_rate[i],"lambda":possible_lambda[j],"mini_batch":mini_batch_size,"dropout":dropout}
+			if os.path.exists(name):
+				continue # trained before the sweep was interrupted
+			# an interrupted configuration resumes from its last epoch
+			net.reset_params()
+			net.SGD(training_data, 50, mini_batch_size, possible_learning_rate[i],validation_data, test_data,lmbda = possible_lambda[j],
+				checkpoint = name + '.checkpoint', log_file = 'sweep_log.jsonl',
+				workers = workers)
 			f = file(name,'wb')
 			cPickle.dump(net,f,protocol=cPickle.HIGHEST_PROTOCOL)
 			f.close()
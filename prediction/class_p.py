@@ -3,30 +3,56 @@
 class network_p():
 
 
-	def __init__(self):
+	def __init__(self, file_name = "params_0.001_0.001_100_0.5.pkl", mask_file = None, engine = 'numpy'):
 
+		# engine 'numpy' runs the network with numpy_inference, without
+		# importing Theano; 'theano' builds it with network_interson
 		self.cPickle = __import__('cPickle')
-		self.Network = __import__('network_interson').Network
-		self.ConvPoolLayer = __import__('layer_types').ConvPoolLayer
-		self.ConvLayer = __import__('layer_types').ConvLayer
-		self.FullyConnectedLayer = __import__('layer_types').FullyConnectedLayer
-		self.SoftmaxLayer = __import__('layer_types').SoftmaxLayer
-		self.ReLU = __import__('network_interson').ReLU
-		self.ndimage = __import__('scipy').ndimage
+		if engine == 'theano':
+			network, layers = __import__('network_interson'), __import__('layer_types')
+		else:
+			network = layers = __import__('numpy_inference')
+		self.Network = network.Network
+		self.ConvPoolLayer = layers.ConvPoolLayer
+		self.ConvLayer = layers.ConvLayer
+		self.FullyConnectedLayer = layers.FullyConnectedLayer
+		self.SoftmaxLayer = layers.SoftmaxLayer
+		self.ReLU = network.ReLU
+		self.ndimage = __import__('scipy.ndimage').ndimage
 		self.np = __import__('numpy')
-		self.imresize = __import__('scipy').misc.imresize
+		self.imresize = __import__('scipy.misc').misc.imresize
+		self.SectorMask = __import__('sector_mask').SectorMask
 		########################################
 		#Get data
 
-		file_name = "params_0.001_0.001_100_0.5.pkl"
-		wei = open(file_name,'rb')
-		weights = self.cPickle.load(wei)
-		wei.close()
+		if engine == 'theano':
+			wei = open(file_name,'rb')
+			weights = self.cPickle.load(wei)
+			wei.close()
+		else:
+			weights = network.load_weights(file_name)
 
-		self.net = self.Network([self.ConvLayer(image_shape=(1, 1, 256,256), filter_shape=(8, 1, 3, 3),activation_fn = self.ReLU, w = weights[0], b = weights[1]), self.ConvPoolLayer(image_shape=(1, 8, 254,254), filter_shape=(8, 8, 3, 3),poolsize=(2, 2), activation_fn = self.ReLU, w = weights[2], b = weights[3]),self.ConvPoolLayer(image_shape=(1, 8, 126,126), filter_shape=(8, 8, 3, 3), poolsize=(2, 2), activation_fn = self.ReLU, w = weights[4], b = weights[5]),self.ConvLayer(image_shape=(1, 8, 62,62),filter_shape=(16, 8, 3, 3), activation_fn = self.ReLU, w = weights[6], b = weights[7]),self.ConvLayer(image_shape=(1, 16, 60,60), filter_shape=(16, 16, 3, 3), activation_fn = self.ReLU, w = weights[8], b = weights[9]),self.ConvPoolLayer(image_shape=(1, 16, 58,58),filter_shape=(16, 16, 3, 3), poolsize=(2, 2), activation_fn = self.ReLU, w = weights[10], b = weights[11]),self.ConvLayer(image_shape=(1, 16, 28,28), 	      filter_shape=(32, 16, 3, 3), activation_fn=self.ReLU, w = weights[12],b = weights[13]),self.ConvPoolLayer(image_shape=(1, 32, 26,26),	      filter_shape=(32, 32, 3, 3), poolsize=(2, 2), activation_fn=self.ReLU, w = weights[14],b = weights[15]),self.ConvLayer(image_shape=(1, 32, 12,12),     filter_shape=(32, 32, 3, 3),	      activation_fn=self.ReLU, w = weights[16],b = weights[17]), self.ConvPoolLayer(image_shape=(1, 32, 10,10), 	      filter_shape=(32, 32,3, 3), poolsize=(2, 2),activation_fn = self.ReLU, w = weights[18],b = weights[19]),self.FullyConnectedLayer(n_in=32*4*4, n_out= 10,activation_fn = self.ReLU, w = weights[20],b = weights[21], p_dropout = 0.0),self.FullyConnectedLayer(n_in=10, n_out= 5,activation_fn = self.ReLU, w = weights[22],b = weights[23], p_dropout = 0.0),self.SoftmaxLayer(n_in=5, n_out=2, w = weights[24],b = weights[25])], 1)
+		# Sector mask used in training (mask_file), if any; the image size
+		# of every layer follows from its crop
+		sector = None
+		s = [(256, 256)]
+		if mask_file:
+			sector = self.SectorMask.load(mask_file, mode='crop')
+			s = [sector.crop_shape]
+		for pool in [0, 1, 1, 0, 0, 1, 0, 1, 0, 1]:
+			r, c = s[-1][0] - 2, s[-1][1] - 2
+			s.append((r // 2, c // 2) if pool else (r, c))
+
+		self.net = self.Network([self.ConvLayer(image_shape=(1, 1)+s[0], filter_shape=(8, 1, 3, 3),activation_fn = self.ReLU, w = weights[0], b = weights[1]), self.ConvPoolLayer(image_shape=(1, 8)+s[1], filter_shape=(8, 8, 3, 3),poolsize=(2, 2), activation_fn = self.ReLU, w = weights[2], b = weights[3]),self.ConvPoolLayer(image_shape=(1, 8)+s[2], filter_shape=(8, 8, 3, 3), poolsize=(2, 2), activation_fn = self.ReLU, w = weights[4], b = weights[5]),self.ConvLayer(image_shape=(1, 8)+s[3],filter_shape=(16, 8, 3, 3), activation_fn = self.ReLU, w = weights[6], b = weights[7]),self.ConvLayer(image_shape=(1, 16)+s[4], filter_shape=(16, 16, 3, 3), activation_fn = self.ReLU, w = weights[8], b = weights[9]),self.ConvPoolLayer(image_shape=(1, 16)+s[5],filter_shape=(16, 16, 3, 3), poolsize=(2, 2), activation_fn = self.ReLU, w = weights[10], b = weights[11]),self.ConvLayer(image_shape=(1, 16)+s[6], 	      filter_shape=(32, 16, 3, 3), activation_fn=self.ReLU, w = weights[12],b = weights[13]),self.ConvPoolLayer(image_shape=(1, 32)+s[7],	      filter_shape=(32, 32, 3, 3), poolsize=(2, 2), activation_fn=self.ReLU, w = weights[14],b = weights[15]),self.ConvLayer(image_shape=(1, 32)+s[8],     filter_shape=(32, 32, 3, 3),	      activation_fn=self.ReLU, w = weights[16],b = weights[17]), self.ConvPoolLayer(image_shape=(1, 32)+s[9], 	      filter_shape=(32, 32,3, 3), poolsize=(2, 2),activation_fn = self.ReLU, w = weights[18],b = weights[19]),self.FullyConnectedLayer(n_in=32*s[10][0]*s[10][1], n_out= 10,activation_fn = self.ReLU, w = weights[20],b = weights[21], p_dropout = 0.0),self.FullyConnectedLayer(n_in=10, n_out= 5,activation_fn = self.ReLU, w = weights[22],b = weights[23], p_dropout = 0.0),self.SoftmaxLayer(n_in=5, n_out=2, w = weights[24],b = weights[25])], 1, input_mask=sector)
+		self.net.optimize_for_inference()
 
 	def prediction(self,i):
 		image_new = self.imresize(i,(256,256))
 		image_new = self.np.reshape(image_new,(1,256*256))
 		a = self.net.predict(image_new)
 		return a[0]
+
+	def predictions(self,images,mini_batch_size = 64):
+		# The network takes any batch size, so many frames are classified per call
+		images_new = self.np.array([self.np.reshape(self.imresize(i,(256,256)),256*256) for i in images])
+		return self.net.predict(images_new, mini_batch_size)
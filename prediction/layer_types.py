@@ -18,6 +18,7 @@ from theano.tensor.nnet import categorical_crossentropy
 from theano.tensor.nnet import softmax, sigmoid
 from theano.tensor import shared_randomstreams
 from theano.tensor.signal import downsample
+import conv_algorithms
 from learning_functions import sgd, apply_nesterov_momentum, nesterov_momentum, get_or_compute_grads
 
 
@@ -27,6 +28,23 @@ def ReLU(z): return T.maximum(0.0, z)
 from theano.tensor.nnet import sigmoid
 from theano.tensor import tanh
 
+def monotonic(activation_fn):
+    """Whether `activation_fn` is non-decreasing, so that it commutes with
+    max-pooling: pooling the maps and then adding the bias (one value per
+    map) and applying the activation gives the same output."""
+    return (activation_fn in (sigmoid, tanh) or
+            getattr(activation_fn, '__name__', None) in ('linear', 'ReLU'))
+
+def folded_weights(layer):
+    """The weights of `layer` with the (1 - p_dropout) scaling of its
+    output folded in, as a new shared variable (the trained weights are
+    left as they are)."""
+    if not layer.p_dropout:
+        return layer.w
+    return theano.shared(
+        np.asarray((1-layer.p_dropout)*layer.w.get_value(), dtype=theano.config.floatX),
+        name='w', borrow=True)
+
 #### Define layer types
 
 
@@ -38,13 +56,16 @@ class ConvPoolLayer():
     simplifies the code, so it makes sense to combine them.
     """
 
-    def __init__(self,filter_shape,image_shape,w,b, poolsize=(2, 2), activation_fn=sigmoid):
+    def __init__(self,filter_shape,image_shape,w,b, poolsize=(2, 2), activation_fn=sigmoid,
+                 algorithm='auto'):
         """`filter_shape` is a tuple of length 4, whose entries are the number
         of filters, the number of input feature maps, the filter height, and the 
         filter width.
         `image_shape` is a tuple of length 4, whose entries are the
         mini-batch size, the number of input feature maps, the image
         height, and the image width.
+        The mini-batch size is only a hint: the batch dimension of the
+        graph is symbolic, so the layer takes any number of images.
         `poolsize` is a tuple of length 2, whose entries are the y and
         x pooling sizes.
         """
@@ -52,6 +73,7 @@ class ConvPoolLayer():
         self.image_shape = image_shape
         self.poolsize = poolsize
         self.activation_fn=activation_fn
+        self.algorithm = algorithm
         #initialize weights and biases
         self.w = theano.shared(
             np.asarray(w,dtype= theano.config.floatX), name = 'w',
@@ -62,20 +84,37 @@ class ConvPoolLayer():
         self.params = [self.w, self.b]
 
     def set_inpt(self, inpt, inpt_dropout, mini_batch_size):
-        self.inpt = inpt.reshape(self.image_shape)
-        conv_out = conv.conv2d(input=self.inpt, filters=self.w, 				filter_shape=self.filter_shape,image_shape=self.image_shape)
+        self.inpt = inpt.reshape((-1,) + tuple(self.image_shape[1:]))
+        conv_out = conv_algorithms.conv2d(self.inpt, self.w, self.filter_shape,
+            self.image_shape, self.algorithm, mini_batch_size)
 	act_out = self.activation_fn(conv_out + self.b.dimshuffle('x',0,'x','x'))
 	pooled_out = downsample.max_pool_2d(input=act_out,ds=self.poolsize,ignore_border=True)
         self.output = pooled_out
         self.output_dropout = self.output # no dropout in the convolutional layers
 
+    def inference_output(self, inpt, mini_batch_size):
+        """The output of `set_inpt` for inference only. With a monotonic
+        activation the maps are pooled first, and the bias and the
+        activation (one fused elementwise pass) only see a quarter of the
+        values."""
+        conv_out = conv_algorithms.conv2d(
+            inpt.reshape((-1,) + tuple(self.image_shape[1:])), self.w,
+            self.filter_shape, self.image_shape, self.algorithm, mini_batch_size)
+        b = self.b.dimshuffle('x',0,'x','x')
+        if not monotonic(self.activation_fn):
+            return downsample.max_pool_2d(input=self.activation_fn(conv_out + b),
+                                          ds=self.poolsize,ignore_border=True)
+        pooled_out = downsample.max_pool_2d(input=conv_out,ds=self.poolsize,ignore_border=True)
+        return self.activation_fn(pooled_out + b)
+
 #######################################
 class ConvLayer():
-    def __init__(self,filter_shape,image_shape,w,b, activation_fn=sigmoid):
+    def __init__(self,filter_shape,image_shape,w,b, activation_fn=sigmoid, algorithm='auto'):
         
         self.filter_shape = filter_shape
         self.image_shape = image_shape
         self.activation_fn=activation_fn
+        self.algorithm = algorithm
         # initialize weights and biases
 	n_in = np.prod(filter_shape[1:])
         n_out = filter_shape[0]*np.prod(filter_shape[2:])
@@ -90,12 +129,20 @@ class ConvLayer():
         self.params = [self.w, self.b]
 
     def set_inpt(self, inpt, inpt_dropout, mini_batch_size):
-        self.inpt = inpt.reshape(self.image_shape)
-        conv_out = conv.conv2d(input=self.inpt, filters=self.w, filter_shape=self.filter_shape,image_shape=self.image_shape)
+        self.inpt = inpt.reshape((-1,) + tuple(self.image_shape[1:]))
+        conv_out = conv_algorithms.conv2d(self.inpt, self.w, self.filter_shape,
+            self.image_shape, self.algorithm, mini_batch_size)
 	act_out = self.activation_fn(conv_out + self.b.dimshuffle('x',0,'x','x'))
         self.output = act_out
         self.output_dropout = self.output # no dropout in the convolutional layers
 
+    def inference_output(self, inpt, mini_batch_size):
+        "The output of `set_inpt` for inference only."
+        conv_out = conv_algorithms.conv2d(
+            inpt.reshape((-1,) + tuple(self.image_shape[1:])), self.w,
+            self.filter_shape, self.image_shape, self.algorithm, mini_batch_size)
+        return self.activation_fn(conv_out + self.b.dimshuffle('x',0,'x','x'))
+
 
 ############################################
 class FullyConnectedLayer():
@@ -115,15 +162,20 @@ class FullyConnectedLayer():
         self.params = [self.w, self.b]
 
     def set_inpt(self, inpt, inpt_dropout, mini_batch_size):
-        self.inpt = inpt.reshape((mini_batch_size, self.n_in))
+        self.inpt = inpt.reshape((-1, self.n_in))
         self.output = self.activation_fn(
             (1-self.p_dropout)*T.dot(self.inpt, self.w) + self.b)
         self.y_out = T.argmax(self.output, axis=1)
         self.inpt_dropout = dropout_layer(
-            inpt_dropout.reshape((mini_batch_size, self.n_in)), self.p_dropout)
+            inpt_dropout.reshape((-1, self.n_in)), self.p_dropout)
         self.output_dropout = self.activation_fn(
             T.dot(self.inpt_dropout, self.w) + self.b)
 
+    def inference_output(self, inpt, mini_batch_size):
+        "The output of `set_inpt` for inference only, the dropout scaling folded into the weights."
+        return self.activation_fn(
+            T.dot(inpt.reshape((-1, self.n_in)), folded_weights(self)) + self.b)
+
 
 class PoolLayer():
 
@@ -132,10 +184,15 @@ class PoolLayer():
         self.poolsize = poolsize
 
      def set_inpt(self, inpt, mini_batch_size):
-        self.inpt = inpt.reshape(self.image_shape)
+        self.inpt = inpt.reshape((-1,) + tuple(self.image_shape[1:]))
 	pooled_out = downsample.max_pool_2d(input=self.inpt,ds=self.poolsize,ignore_border=True)
         self.output = pooled_out
 
+     def inference_output(self, inpt, mini_batch_size):
+        return downsample.max_pool_2d(
+            input=inpt.reshape((-1,) + tuple(self.image_shape[1:])),
+            ds=self.poolsize,ignore_border=True)
+
 
 #######################################
 class SoftmaxLayer():
@@ -154,13 +211,17 @@ class SoftmaxLayer():
         self.params = [self.w, self.b]
 
     def set_inpt(self, inpt, inpt_dropout, mini_batch_size):
-        self.inpt = inpt.reshape((mini_batch_size, self.n_in))
+        self.inpt = inpt.reshape((-1, self.n_in))
         self.output = softmax((1-self.p_dropout)*T.dot(self.inpt, self.w) + self.b)
         self.y_out = T.argmax(self.output, axis=1)
         self.inpt_dropout = dropout_layer(
-            inpt_dropout.reshape((mini_batch_size, self.n_in)), self.p_dropout)
+            inpt_dropout.reshape((-1, self.n_in)), self.p_dropout)
         self.output_dropout = softmax(T.dot(self.inpt_dropout, self.w) + self.b)
 
+    def inference_output(self, inpt, mini_batch_size):
+        "The output of `set_inpt` for inference only, the dropout scaling folded into the weights."
+        return softmax(T.dot(inpt.reshape((-1, self.n_in)), folded_weights(self)) + self.b)
+
     #def cost(self, net):
     #    "Return the log-likelihood cost."
     #    return -T.mean(T.log(self.output_dropout)[T.arange(net.y.shape[0]), net.y])
@@ -201,13 +262,17 @@ class SigmoidLayer():
         self.params = [self.w, self.b]
 
     def set_inpt(self, inpt, inpt_dropout, mini_batch_size):
-        self.inpt = inpt.reshape((mini_batch_size, self.n_in))
+        self.inpt = inpt.reshape((-1, self.n_in))
         self.output = softmax((1-self.p_dropout)*T.dot(self.inpt, self.w) + self.b)
         self.y_out = T.argmax(self.output, axis=1)
         self.inpt_dropout = dropout_layer(
-            inpt_dropout.reshape((mini_batch_size, self.n_in)), self.p_dropout)
+            inpt_dropout.reshape((-1, self.n_in)), self.p_dropout)
         self.output_dropout = softmax(T.dot(self.inpt_dropout, self.w) + self.b)
 
+    def inference_output(self, inpt, mini_batch_size):
+        "The output of `set_inpt` for inference only, the dropout scaling folded into the weights."
+        return softmax(T.dot(inpt.reshape((-1, self.n_in)), folded_weights(self)) + self.b)
+
     def cost(self, net):
         "Return the binary cross entropy function"
 	return T.mean(binary_crossentropy(self.output_dropout,net.y))
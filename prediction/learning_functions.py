@@ -94,7 +94,9 @@ def sgd(loss_or_grads, params, learning_rate):
     params : list of shared variables
         The variables to generate update expressions for
     learning_rate : float or symbolic scalar
-        The learning rate controlling the size of update steps
+        The learning rate controlling the size of update steps. A shared
+        scalar can be changed with `set_value` between calls of the
+        compiled function, without compiling it again.
     Returns
     -------
     OrderedDict
@@ -163,7 +165,9 @@ def momentum(loss_or_grads, params, learning_rate, momentum=0.9):
     params : list of shared variables
         The variables to generate update expressions for
     learning_rate : float or symbolic scalar
-        The learning rate controlling the size of update steps
+        The learning rate controlling the size of update steps. A shared
+        scalar can be changed with `set_value` between calls of the
+        compiled function, without compiling it again.
     momentum : float or symbolic scalar, optional
         The amount of momentum to apply. Higher momentum results in
         smoothing over more update steps. Defaults to 0.9.
@@ -243,7 +247,9 @@ def nesterov_momentum(loss_or_grads, params, learning_rate, momentum=0.9):
     params : list of shared variables
         The variables to generate update expressions for
     learning_rate : float or symbolic scalar
-        The learning rate controlling the size of update steps
+        The learning rate controlling the size of update steps. A shared
+        scalar can be changed with `set_value` between calls of the
+        compiled function, without compiling it again.
     momentum : float or symbolic scalar, optional
         The amount of momentum to apply. Higher momentum results in
         smoothing over more update steps. Defaults to 0.9.
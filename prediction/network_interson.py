@@ -59,10 +59,12 @@ if GPU:
 
 class Network():
     
-    def __init__(self, layers, mini_batch_size):
+    def __init__(self, layers, mini_batch_size, input_mask=None):
         """Takes a list of `layers`, describing the network architecture, and
         a value for the `mini_batch_size` to be used during training
         by stochastic gradient descent.
+        `input_mask` is the sector_mask.SectorMask the network was trained
+        with, if any; it is applied to the frames as in training.
 
         """
         self.layers = layers
@@ -70,19 +72,53 @@ class Network():
         self.params = [param for layer in self.layers for param in layer.params]
         self.x = T.matrix("x")  
         self.y = T.ivector("y")
+        self.input_mask = input_mask
+        inpt = self.x
+        if input_mask is not None:
+            inpt = input_mask.apply(inpt)
         init_layer = self.layers[0]
-        init_layer.set_inpt(self.x, self.x, self.mini_batch_size)
+        init_layer.set_inpt(inpt, inpt, self.mini_batch_size)
         for j in xrange(1, len(self.layers)):
             prev_layer, layer  = self.layers[j-1], self.layers[j]
             layer.set_inpt(
                 prev_layer.output, prev_layer.output_dropout, self.mini_batch_size)
         self.output = self.layers[-1].output
         self.output_dropout = self.layers[-1].output_dropout
+        self.y_out = self.layers[-1].y_out
 
-    def predict(self,test_data,mini_batch_size = 1):
-	   self.test_mb_predictions = theano.function([self.x],self.layers[-1].y_out)
-	   predictions = self.test_mb_predictions(test_data)
-	   return predictions
+    def optimize_for_inference(self):
+        """Rebuild the prediction graph of the trained network for inference
+        only, from the `inference_output` of the layers: the dropout scaling
+        is folded into copies of the weights, and the convolutional layers
+        with a monotonic activation pool before adding the bias and applying
+        the activation. The outputs are those of the original graph up to
+        rounding. Returns the network.
+
+        """
+        inpt = self.x
+        if self.input_mask is not None:
+            inpt = self.input_mask.apply(inpt)
+        for layer in self.layers:
+            inpt = layer.inference_output(inpt, self.mini_batch_size)
+        self.output = inpt
+        self.y_out = T.argmax(self.output, axis=1)
+        self.test_mb_predictions = None
+        return self
+
+    def predict(self,test_data,mini_batch_size = None):
+        """Return the predicted class of every row of `test_data`. The
+        prediction function is compiled on the first call only, and since
+        the layers take any batch size the rows are fed `mini_batch_size`
+        at a time (all at once by default).
+
+        """
+        if getattr(self, 'test_mb_predictions', None) is None:
+            self.test_mb_predictions = theano.function([self.x],self.y_out)
+        if mini_batch_size is None:
+            return self.test_mb_predictions(test_data)
+        return np.concatenate([
+            self.test_mb_predictions(test_data[k:k+mini_batch_size])
+            for k in xrange(0, len(test_data), mini_batch_size)])
 
 #### Miscellanea
 def size(data):
@@ -0,0 +1,210 @@
+'''
+numpy_inference.py: Run the trained networks with NumPy only.
+
+Classifying a frame with network_interson means importing Theano, building the
+graph and compiling it (with a C compiler) before the first answer. The classes
+below take the same arguments as the ones of layer_types.py and network_interson
+(w and b being the arrays of the saved weight list), so class_p builds the same
+network with either module, but they only run the forward pass, in NumPy:
+
+    convolutions  the activations are kept as (images, rows, columns, maps);
+                  every 3x3 window of a batch of images is laid out as one
+                  row of a matrix (im2col, a strided view copied once) and
+                  multiplied by the flipped filters in a single GEMM.
+    pooling       a reshape and a max over the 2x2 blocks (ignore_border).
+    dense layers  a GEMM per layer, the softmax for the class probabilities;
+                  the dropout scaling is folded into the weights.
+
+Network.optimize_for_inference makes the convolutional layers with a monotonic
+activation pool before adding the bias and applying the activation, as in
+network_interson.
+
+The weight pickles of the GPU runs hold CudaNdarrays; load_weights reads them
+as numpy arrays, without Theano or CUDA.
+
+command line: python numpy_inference.py params_0.001_0.001_100_0.5.pkl frame.png [frame.png ...]
+'''
+
+#### Libraries
+# Standard library
+import cPickle
+
+# Third-party libraries
+import numpy as np
+
+
+def load_weights(filename):
+    """Return the list of weight arrays pickled in `filename` (as saved from
+    the `params` of a trained network), as float32 numpy arrays."""
+    def find_global(module, name):
+        if (module, name) == ('theano.sandbox.cuda.type', 'CudaNdarray_unpickler'):
+            return np.asarray
+        return getattr(__import__(module, fromlist=[name]), name)
+    f = open(filename, 'rb')
+    unpickler = cPickle.Unpickler(f)
+    unpickler.find_global = find_global
+    weights = unpickler.load()
+    f.close()
+    return [np.asarray(getattr(w, 'get_value', lambda: w)(), dtype='float32')
+            for w in weights]
+
+# Activation functions for neurons
+def linear(z): return z
+def ReLU(z): return np.maximum(z, 0, out=z)
+def sigmoid(z): return 1.0 / (1.0 + np.exp(-z))
+tanh = np.tanh
+
+def monotonic(activation_fn):
+    """Whether `activation_fn` is non-decreasing, so that it commutes with
+    max-pooling (see layer_types.monotonic)."""
+    return (activation_fn in (sigmoid, tanh) or
+            getattr(activation_fn, '__name__', None) in ('linear', 'ReLU'))
+
+def im2col(images, filter_rows, filter_cols):
+    """Return the matrix whose rows are the `filter_rows` x `filter_cols`
+    windows (valid positions) of `images`, an array (images, rows, columns,
+    maps); each row is ordered (window row, window column, map)."""
+    n, rows, cols, maps = images.shape
+    out_rows, out_cols = rows - filter_rows + 1, cols - filter_cols + 1
+    s = images.strides
+    windows = np.lib.stride_tricks.as_strided(
+        images, (n, out_rows, out_cols, filter_rows, filter_cols, maps),
+        (s[0], s[1], s[2], s[1], s[2], s[3]))
+    return windows.reshape(n * out_rows * out_cols, filter_rows * filter_cols * maps)
+
+
+#### Layer types
+class ConvLayer(object):
+
+    def __init__(self, filter_shape, image_shape, w, b, activation_fn=ReLU,
+                 poolsize=None):
+        """Same arguments as layer_types.ConvLayer; `image_shape[0]` is
+        ignored. Theano's conv2d flips the filters, so they are flipped
+        here once and laid out as a (rows*columns*maps, filters) matrix."""
+        self.filter_shape = filter_shape
+        self.image_shape = image_shape
+        self.activation_fn = activation_fn
+        self.poolsize = poolsize
+        self.pool_first = False
+        w = np.asarray(w, dtype='float32')[:, :, ::-1, ::-1]
+        self.w = np.ascontiguousarray(w.transpose(2, 3, 1, 0)).reshape(-1, filter_shape[0])
+        self.b = np.asarray(b, dtype='float32')
+
+    def feedforward(self, a):
+        "`a` is an array (images, rows, columns, maps)."
+        n = a.shape[0]
+        rows = a.shape[1] - self.filter_shape[2] + 1
+        cols = a.shape[2] - self.filter_shape[3] + 1
+        z = np.dot(im2col(a, self.filter_shape[2], self.filter_shape[3]), self.w)
+        z = z.reshape(n, rows, cols, self.filter_shape[0])
+        if self.poolsize and self.pool_first:
+            z = self.pool(z)
+        z += self.b
+        a = self.activation_fn(z)
+        if self.poolsize and not self.pool_first:
+            a = self.pool(a)
+        return a
+
+    def pool(self, a):
+        "Max-pooling (ignore_border) as the maximum of the strided views of the blocks."
+        pr, pc = self.poolsize
+        rows, cols = a.shape[1] // pr * pr, a.shape[2] // pc * pc
+        out = a[:, 0:rows:pr, 0:cols:pc].copy()
+        for i in xrange(pr):
+            for j in xrange(pc):
+                if i or j:
+                    np.maximum(out, a[:, i:rows:pr, j:cols:pc], out=out)
+        return out
+
+class ConvPoolLayer(ConvLayer):
+
+    def __init__(self, filter_shape, image_shape, w, b, poolsize=(2, 2),
+                 activation_fn=ReLU):
+        ConvLayer.__init__(self, filter_shape, image_shape, w, b,
+                           activation_fn, poolsize)
+
+class FullyConnectedLayer(object):
+
+    def __init__(self, n_in, n_out, w, b, activation_fn=ReLU, p_dropout=0.0):
+        self.n_in = n_in
+        self.n_out = n_out
+        self.activation_fn = activation_fn
+        self.w = (1 - p_dropout) * np.asarray(w, dtype='float32')
+        self.b = np.asarray(b, dtype='float32')
+
+    def feedforward(self, a):
+        return self.activation_fn(np.dot(flatten(a, self.n_in), self.w) + self.b)
+
+class SoftmaxLayer(object):
+
+    def __init__(self, n_in, n_out, w, b, p_dropout=0.0):
+        self.n_in = n_in
+        self.n_out = n_out
+        self.w = (1 - p_dropout) * np.asarray(w, dtype='float32')
+        self.b = np.asarray(b, dtype='float32')
+
+    def feedforward(self, a):
+        z = np.dot(flatten(a, self.n_in), self.w) + self.b
+        z = np.exp(z - z.max(axis=1)[:, None])
+        return z / z.sum(axis=1)[:, None]
+
+def flatten(a, n_in):
+    """Rows of `n_in` inputs; feature maps are flattened in Theano's order
+    (maps, rows, columns)."""
+    if a.ndim == 4:
+        a = a.transpose(0, 3, 1, 2)
+    return a.reshape(-1, n_in)
+
+
+#### Network
+class Network(object):
+
+    def __init__(self, layers, mini_batch_size=16, input_mask=None):
+        """Same arguments as network_interson.Network. `mini_batch_size` is
+        the number of frames run through the layers at once, which bounds
+        the size of the im2col matrices."""
+        self.layers = layers
+        self.mini_batch_size = mini_batch_size
+        self.input_mask = input_mask
+
+    def optimize_for_inference(self):
+        """Make the convolutional layers with a monotonic activation pool
+        before adding the bias and applying the activation, on a quarter of
+        the values. Returns the network."""
+        for layer in self.layers:
+            if getattr(layer, 'poolsize', None):
+                layer.pool_first = monotonic(layer.activation_fn)
+        return self
+
+    def feedforward(self, x, mini_batch_size=None):
+        """Return the class probabilities of the rows of `x` (flattened
+        frames), run `mini_batch_size` (that of the network by default) at
+        a time."""
+        mini_batch_size = mini_batch_size or self.mini_batch_size
+        x = np.asarray(x)
+        if self.input_mask is not None:
+            x = self.input_mask.apply(x)
+        outputs = []
+        for k in xrange(0, len(x), mini_batch_size):
+            a = np.asarray(x[k:k + mini_batch_size], dtype='float32')
+            first = self.layers[0]
+            if hasattr(first, 'filter_shape'):
+                # the rows are flattened in Theano's order (maps, rows, columns)
+                a = a.reshape((-1,) + tuple(first.image_shape[1:])).transpose(0, 2, 3, 1)
+            for layer in self.layers:
+                a = layer.feedforward(a)
+            outputs.append(a)
+        return np.concatenate(outputs)
+
+    def predict(self, x, mini_batch_size=None):
+        "Return the predicted class of every row of `x` (see `feedforward`)."
+        return np.argmax(self.feedforward(x, mini_batch_size), axis=1)
+
+
+if __name__ == '__main__':
+    import sys
+    from scipy import misc
+    from class_p import network_p
+    net = network_p(sys.argv[1])
+    for name in sys.argv[2:]:
+        print name, net.prediction(misc.imread(name, mode='L'))